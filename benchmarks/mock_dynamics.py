@@ -0,0 +1,556 @@
+#!/usr/bin/env python3
+"""Local stand-in for the Dynamics 365 Web API used by the benchmarks.
+
+Serves a synthetic tenant: a `$metadata` document with any number of entity
+types, paged entity sets with `@odata.nextLink`, saved and personal views,
+FetchXML paging, `$batch`, `EntityDefinitions` and the OAuth token endpoint.
+`$filter` comparisons, `$orderby`, `$top`, FetchXML conditions and change
+tracking delta links are honoured, so every sync mode reads the rows it
+would read from a real org. Latency and 429 throttling can be simulated.
+
+    python benchmarks/mock_dynamics.py --entities 500 --rows 20000 --port 8765
+"""
+
+import argparse
+import hashlib
+import json
+import operator
+import random
+import re
+import threading
+import time
+import uuid
+import xml.etree.ElementTree as ET
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, unquote, urlencode, urlsplit
+
+API_PREFIX = "/api/data/v9.0/"
+NAMESPACE = "Microsoft.Dynamics.CRM"
+DEFAULT_PAGE_SIZE = 5000
+
+# entity sets that carry data, all of them are in the tap's discovery list
+DATA_ENTITIES = {
+    "accounts": "account",
+    "contacts": "contact",
+    "leads": "lead",
+    "opportunities": "opportunity",
+}
+VIEW_ENTITIES = {"savedqueries": "savedquery", "userqueries": "userquery"}
+BASE_TIME = datetime(2020, 1, 1, tzinfo=timezone.utc)
+VIEW_COLUMNS = {"@odata.etag", "name", "modifiedon"}
+
+OPERATORS = {
+    "eq": operator.eq,
+    "ne": operator.ne,
+    "gt": operator.gt,
+    "ge": operator.ge,
+    "lt": operator.lt,
+    "le": operator.le,
+}
+FILTER_CLAUSE = re.compile(r"^(\w+) (eq|ne|gt|ge|lt|le) (.+)$")
+MAX_CACHED_QUERIES = 64
+
+
+def parse_literal(value):
+    if value.startswith("'") and value.endswith("'"):
+        return value[1:-1].replace("''", "'")
+    if value in ("true", "false"):
+        return value == "true"
+    if value == "null":
+        return None
+    if re.match(r"^\d{4}-\d{2}-\d{2}", value):
+        # a '+' offset sent without URL encoding arrives as a space
+        parsed = datetime.fromisoformat(value.replace(" ", "+").replace("Z", "+00:00"))
+        return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def parse_filter(expression):
+    # only what the tap sends: comparisons joined with "and"
+    clauses = []
+    for clause in re.split(r"\s+and\s+", expression.strip(), flags=re.IGNORECASE):
+        clause = clause.strip().strip("()").strip()
+        match = FILTER_CLAUSE.match(clause)
+        if not match:
+            raise ValueError("Unsupported $filter clause: {}".format(clause))
+        field, op, value = match.groups()
+        clauses.append((field, OPERATORS[op], parse_literal(value)))
+    return clauses
+
+
+def parse_fetch_conditions(fetch):
+    return [
+        (
+            condition.get("attribute"),
+            OPERATORS[condition.get("operator")],
+            parse_literal(condition.get("value")),
+        )
+        for condition in fetch.iter("condition")
+    ]
+
+
+class Tenant:
+    def __init__(
+        self,
+        entities=50,
+        rows=2000,
+        columns=20,
+        views=4,
+        lookup_tables=0,
+        latency_ms=0,
+        throttle_rate=0.0,
+        retry_after=0,
+        change_tracking=(),
+        seed=1,
+    ):
+        self.entities = entities
+        self.rows = rows
+        self.columns = columns
+        self.views = views
+        self.lookup_tables = lookup_tables
+        self.latency = latency_ms / 1000.0
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.change_tracking = set(change_tracking)
+        self.random = random.Random(seed)
+
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.sets = self.entity_sets()
+        self.queries = {}
+        self.metadata = self.build_metadata().encode("utf-8")
+        self.etag = 'W/"{}"'.format(hashlib.sha1(self.metadata).hexdigest())
+
+    def count(self, kind):
+        with self.lock:
+            self.stats[kind] = self.stats.get(kind, 0) + 1
+
+    def reset_stats(self):
+        with self.lock:
+            stats, self.stats = self.stats, {}
+        return stats
+
+    def should_throttle(self):
+        with self.lock:
+            return self.random.random() < self.throttle_rate
+
+    def entity_sets(self):
+        sets = dict(DATA_ENTITIES)
+        sets.update(VIEW_ENTITIES)
+        for i in range(self.entities):
+            sets["new_entity{}s".format(i)] = "new_entity{}".format(i)
+        for i in range(self.lookup_tables):
+            sets["new_lkup{}s".format(i)] = "new_lkup{}".format(i)
+        return sets
+
+    def build_metadata(self):
+        types = []
+        sets = []
+        for set_name, type_name in self.sets.items():
+            properties = [
+                '<Property Name="{}id" Type="Edm.Guid" />'.format(type_name),
+                '<Property Name="name" Type="Edm.String" />',
+                '<Property Name="createdon" Type="Edm.DateTimeOffset" />',
+                '<Property Name="modifiedon" Type="Edm.DateTimeOffset" />',
+                '<Property Name="statecode" Type="Edm.Int32" />',
+                '<Property Name="revenue" Type="Edm.Decimal" />',
+                '<Property Name="donotemail" Type="Edm.Boolean" />',
+            ]
+            if type_name in VIEW_ENTITIES.values():
+                properties += [
+                    '<Property Name="returnedtypecode" Type="Edm.String" />',
+                    '<Property Name="fetchxml" Type="Edm.String" />',
+                ]
+            properties += [
+                '<Property Name="new_column{}" Type="Edm.String" />'.format(i)
+                for i in range(self.columns)
+            ]
+            types.append(
+                '<EntityType Name="{0}"><Key><PropertyRef Name="{0}id" /></Key>'
+                "{1}</EntityType>".format(type_name, "".join(properties))
+            )
+            sets.append(
+                '<EntitySet Name="{}" EntityType="{}.{}" />'.format(
+                    set_name, NAMESPACE, type_name
+                )
+            )
+
+        return (
+            '<?xml version="1.0" encoding="utf-8"?>'
+            '<edmx:Edmx Version="4.0" xmlns:edmx="http://docs.oasis-open.org/odata/ns/edmx">'
+            "<edmx:DataServices>"
+            '<Schema Namespace="{}" Alias="mscrm" xmlns="http://docs.oasis-open.org/odata/ns/edm">'
+            "{}"
+            '<EntityContainer Name="System">{}</EntityContainer>'
+            "</Schema></edmx:DataServices></edmx:Edmx>"
+        ).format(NAMESPACE, "".join(types), "".join(sets))
+
+    def row_count(self, set_name):
+        if set_name in DATA_ENTITIES:
+            return self.rows
+        if set_name in VIEW_ENTITIES:
+            return self.views
+        if "lkup" in set_name:
+            return 20
+        return 0
+
+    def get_key(self, set_name, index):
+        return str(uuid.uuid5(uuid.NAMESPACE_OID, "{}-{}".format(set_name, index)))
+
+    def get_modified(self, index):
+        return BASE_TIME + timedelta(minutes=index)
+
+    def field_value(self, set_name, index, field):
+        if field in ("createdon", "modifiedon"):
+            return self.get_modified(index)
+        if field == "{}id".format(self.sets[set_name]):
+            return self.get_key(set_name, index)
+        if field == "returnedtypecode":
+            return "lead" if index % 2 == 0 else "contact"
+        return self.make_row(set_name, index).get(field)
+
+    def matches(self, set_name, index, clauses):
+        for field, compare, value in clauses:
+            field_value = self.field_value(set_name, index, field)
+            if field_value is None or value is None:
+                if not (compare is operator.eq and field_value is value):
+                    return False
+            elif not compare(field_value, value):
+                return False
+        return True
+
+    def query(self, set_name, clauses, order_by):
+        # the rows matching a query, in order; cached so that following a
+        # nextLink doesn't filter the whole table again
+        cache_key = (set_name, repr(clauses), order_by)
+        with self.lock:
+            if cache_key in self.queries:
+                return self.queries[cache_key]
+
+        indices = range(self.row_count(set_name))
+        if order_by:
+            field, _, direction = order_by.split(",")[0].strip().partition(" ")
+            # rows are generated in modifiedon order
+            if field not in ("createdon", "modifiedon"):
+                indices = sorted(
+                    indices, key=lambda index: self.field_value(set_name, index, field)
+                )
+            if direction.strip().lower() == "desc":
+                indices = list(reversed(indices))
+        if clauses:
+            indices = [
+                index for index in indices if self.matches(set_name, index, clauses)
+            ]
+
+        with self.lock:
+            if len(self.queries) >= MAX_CACHED_QUERIES:
+                self.queries.clear()
+            self.queries[cache_key] = indices
+        return indices
+
+    def make_row(self, set_name, index, select=None):
+        type_name = self.sets[set_name]
+        modified = self.get_modified(index)
+        row = {
+            "@odata.etag": 'W/"{}"'.format(index),
+            "{}id".format(type_name): self.get_key(set_name, index),
+            "name": "{} {}".format(type_name, index),
+            "createdon": modified.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "modifiedon": modified.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "statecode": index % 2,
+            "revenue": index * 1.5,
+            "donotemail": index % 3 == 0,
+        }
+        for i in range(self.columns):
+            row["new_column{}".format(i)] = "value {} {}".format(i, index)
+        if set_name in VIEW_ENTITIES:
+            row["returnedtypecode"] = "lead" if index % 2 == 0 else "contact"
+            row["fetchxml"] = (
+                '<fetch version="1.0" mapping="logical"><entity name="{}">'
+                '<attribute name="name" /><attribute name="modifiedon" />'
+                "</entity></fetch>".format(row["returnedtypecode"])
+            )
+        if select:
+            row = {key: value for key, value in row.items() if key in select}
+        return row
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    tenant = None
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, data, status=200, headers=None):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; odata.metadata=minimal")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length) if length else b""
+
+    def simulate(self):
+        if self.tenant.latency:
+            time.sleep(self.tenant.latency)
+        if self.tenant.should_throttle():
+            self.tenant.count("throttled")
+            self.send_json(
+                {"error": {"code": "0x80072322", "message": "Number of requests exceeded the limit"}},
+                status=429,
+                headers={"Retry-After": str(self.tenant.retry_after)},
+            )
+            return True
+        return False
+
+    def do_GET(self):
+        self.read_body()
+        self.tenant.count("requests")
+        if self.path.startswith("/__stats"):
+            self.send_json(self.tenant.reset_stats())
+            return
+        if self.simulate():
+            return
+        status, headers, data = self.dispatch_get(self.path, self.headers)
+        if isinstance(data, bytes):
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self.send_json(data, status, headers)
+
+    def do_POST(self):
+        body = self.read_body()
+        self.tenant.count("requests")
+        if self.path.endswith("/oauth2/token"):
+            self.tenant.count("token")
+            self.send_json(
+                {
+                    "access_token": uuid.uuid4().hex,
+                    "refresh_token": uuid.uuid4().hex,
+                    "expires_in": "3600",
+                }
+            )
+            return
+        if self.simulate():
+            return
+        if self.path.endswith("$batch"):
+            self.tenant.count("batch")
+            self.handle_batch(body)
+            return
+        self.send_json({"error": {"message": "not found"}}, status=404)
+
+    def dispatch_get(self, path, headers):
+        url = urlsplit(path)
+        resource = unquote(url.path)[len(API_PREFIX):]
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        if resource.rstrip("/") == "$metadata":
+            self.tenant.count("metadata")
+            if headers.get("If-None-Match") == self.tenant.etag:
+                return 304, {"ETag": self.tenant.etag}, b""
+            return (
+                200,
+                {"Content-Type": "application/xml", "ETag": self.tenant.etag},
+                self.tenant.metadata,
+            )
+
+        if resource == "EntityDefinitions":
+            return 200, {}, {
+                "value": [
+                    {"EntitySetName": set_name, "ChangeTrackingEnabled": True}
+                    for set_name in sorted(self.tenant.change_tracking)
+                ]
+            }
+
+        match = re.match(r"^(\w+)\(([^)]*)\)$", resource)
+        if match:
+            set_name, key = match.groups()
+            for index in range(self.tenant.row_count(set_name)):
+                row = self.tenant.make_row(set_name, index)
+                if key in row.values():
+                    return 200, {}, row
+            return 404, {}, {"error": {"message": "not found"}}
+
+        if resource not in self.tenant.sets:
+            return 404, {}, {"error": {"message": "Resource not found: " + resource}}
+
+        self.tenant.count("pages")
+        try:
+            if "fetchXml" in params:
+                return 200, {}, self.fetchxml_page(resource, params["fetchXml"])
+            return 200, {}, self.entity_page(resource, params, headers)
+        except ValueError as exc:
+            return 400, {}, {"error": {"message": str(exc)}}
+
+    def get_page_size(self, headers):
+        match = re.search(r"odata\.maxpagesize=(\d+)", headers.get("Prefer", ""))
+        return int(match.group(1)) if match else DEFAULT_PAGE_SIZE
+
+    def delta_link(self, set_name):
+        return "{}{}?$deltatoken={}".format(self.base_url(), set_name, int(time.time()))
+
+    def entity_page(self, set_name, params, headers):
+        context = "{}$metadata#{}".format(self.base_url(), set_name)
+        if "$deltatoken" in params:
+            # the synthetic tenant never changes, so there are no changes to report
+            self.tenant.count("delta")
+            return {
+                "@odata.context": context,
+                "value": [],
+                "@odata.deltaLink": self.delta_link(set_name),
+            }
+
+        select = set(params["$select"].split(",")) if "$select" in params else None
+        if select is not None:
+            select.add("@odata.etag")
+        if params.get("savedQuery") or params.get("userQuery"):
+            select = VIEW_COLUMNS
+
+        clauses = parse_filter(params["$filter"]) if "$filter" in params else []
+        indices = self.tenant.query(set_name, clauses, params.get("$orderby"))
+        if "$top" in params:
+            indices = indices[: int(params["$top"])]
+
+        page_size = self.get_page_size(headers)
+        offset = int(params.pop("$skiptoken", 0))
+        rows = [
+            self.tenant.make_row(set_name, index, select)
+            for index in indices[offset : offset + page_size]
+        ]
+
+        data = {"@odata.context": context, "value": rows}
+        if offset + page_size < len(indices):
+            params["$skiptoken"] = str(offset + page_size)
+            data["@odata.nextLink"] = "{}{}?{}".format(
+                self.base_url(), set_name, urlencode(params, safe="$,'", quote_via=quote)
+            )
+        elif "odata.track-changes" in headers.get("Prefer", ""):
+            data["@odata.deltaLink"] = self.delta_link(set_name)
+        return data
+
+    def fetchxml_page(self, set_name, fetchxml):
+        fetch = ET.fromstring(fetchxml)
+        count = int(fetch.get("count", DEFAULT_PAGE_SIZE))
+        page = int(fetch.get("page", 1))
+        indices = self.tenant.query(set_name, parse_fetch_conditions(fetch), None)
+
+        offset = (page - 1) * count
+        rows = [
+            self.tenant.make_row(set_name, index, VIEW_COLUMNS)
+            for index in indices[offset : offset + count]
+        ]
+        data = {
+            "value": rows,
+            "@Microsoft.Dynamics.CRM.morerecords": offset + count < len(indices),
+        }
+        if data["@Microsoft.Dynamics.CRM.morerecords"]:
+            cookie = quote(quote('<cookie page="{}"></cookie>'.format(page)))
+            data["@Microsoft.Dynamics.CRM.fetchxmlpagingcookie"] = (
+                '<cookie pagenumber="{}" pagingcookie="{}" istracking="False" />'.format(
+                    page + 1, cookie
+                )
+            )
+        return data
+
+    def handle_batch(self, body):
+        boundary = re.search(r"boundary=([^;]+)", self.headers["Content-Type"]).group(1)
+        parts = body.decode("utf-8").split("--" + boundary)[1:]
+
+        response_boundary = "batchresponse_{}".format(uuid.uuid4().hex)
+        chunks = []
+        for part in parts:
+            if part.startswith("--"):
+                break
+            _, _, http_request = part.partition("\r\n\r\n")
+            request_line, _, raw_headers = http_request.partition("\r\n")
+            headers = {}
+            for line in raw_headers.split("\r\n"):
+                if ": " in line:
+                    name, value = line.split(": ", 1)
+                    headers[name] = value
+            path = urlsplit(request_line.split(" ")[1])
+            status, _, data = self.dispatch_get(
+                path.path + ("?" + path.query if path.query else ""), headers
+            )
+            chunks.append(
+                "--{}\r\nContent-Type: application/http\r\nContent-Transfer-Encoding: binary\r\n\r\n"
+                "HTTP/1.1 {} OK\r\nContent-Type: application/json\r\n\r\n{}\r\n".format(
+                    response_boundary, status, json.dumps(data)
+                )
+            )
+        chunks.append("--{}--\r\n".format(response_boundary))
+
+        payload = "".join(chunks).encode("utf-8")
+        self.send_response(200)
+        self.send_header(
+            "Content-Type", "multipart/mixed; boundary={}".format(response_boundary)
+        )
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def base_url(self):
+        return "http://{}:{}{}".format(
+            self.server.server_address[0], self.server.server_address[1], API_PREFIX
+        )
+
+
+def start_server(tenant, host="127.0.0.1", port=0):
+    handler = type("TenantHandler", (Handler,), {"tenant": tenant})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--entities", type=int, default=50)
+    parser.add_argument("--rows", type=int, default=2000)
+    parser.add_argument("--columns", type=int, default=20)
+    parser.add_argument("--lookup-tables", type=int, default=0)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=int, default=0)
+    parser.add_argument(
+        "--change-tracking", default="", help="comma separated entity sets with change tracking"
+    )
+    args = parser.parse_args()
+
+    tenant = Tenant(
+        entities=args.entities,
+        rows=args.rows,
+        columns=args.columns,
+        lookup_tables=args.lookup_tables,
+        latency_ms=args.latency_ms,
+        throttle_rate=args.throttle_rate,
+        retry_after=args.retry_after,
+        change_tracking=[name for name in args.change_tracking.split(",") if name],
+    )
+    server = start_server(tenant, port=args.port)
+    print("Mock Dynamics listening on http://127.0.0.1:{}".format(server.server_address[1]))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""Run tap-dynamics end to end against synthetic tenants served by mock_dynamics.
+
+Every tenant gets a discovery run and a sync run, each in a fresh process, and
+the harness reports startup time, discovery time, records per second, peak RSS
+and the requests the mock served. Every view in the discovered catalog is
+selected before the sync, and a sync that does not emit exactly the records the
+tenant holds for the catalog fails the run.
+
+    python benchmarks/run_benchmarks.py --tenant small --tenant medium
+    python benchmarks/run_benchmarks.py --tap-config extra.json --output results.json
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from mock_dynamics import Tenant, start_server
+
+TENANTS = {
+    "small": {"entities": 50, "rows": 2000, "columns": 20, "lookup_tables": 2},
+    "medium": {"entities": 500, "rows": 20000, "columns": 60, "lookup_tables": 10},
+    "large": {"entities": 2000, "rows": 100000, "columns": 150, "lookup_tables": 40},
+}
+
+# view streams read the rows of these entity sets once per selected view
+VIEW_ENTITY_SETS = {
+    "view_leads": "leads",
+    "view_personal_leads": "leads",
+    "view_contacts": "contacts",
+    "view_personal_contacts": "contacts",
+}
+
+TAP_COMMAND = [sys.executable, "-c", "from tap_dynamics import main; main()"]
+
+
+def write_json(path, data):
+    with open(path, "w") as outfile:
+        json.dump(data, outfile)
+
+
+def select_views(catalog_path):
+    with open(catalog_path) as infile:
+        catalog = json.load(infile)
+    for stream in catalog["streams"]:
+        if stream["tap_stream_id"] in VIEW_ENTITY_SETS:
+            for entry in stream["metadata"]:
+                if entry["breadcrumb"]:
+                    entry["metadata"]["selected"] = True
+    write_json(catalog_path, catalog)
+    return catalog
+
+
+def get_expected_records(tenant, catalog):
+    expected = 0
+    for stream in catalog["streams"]:
+        stream_id = stream["tap_stream_id"]
+        if stream_id in VIEW_ENTITY_SETS:
+            views = [
+                entry
+                for entry in stream["metadata"]
+                if entry["breadcrumb"] and entry["metadata"].get("selected")
+            ]
+            expected += len(views) * tenant.row_count(VIEW_ENTITY_SETS[stream_id])
+        else:
+            expected += tenant.row_count(stream_id)
+    return expected
+
+
+def run_tap(args, stdout_path, log_path):
+    # the tap runs in its own process so its RSS and import time are measured
+    counts = {}
+    first_message = None
+    started = time.perf_counter()
+    with open(stdout_path, "w") as stdout_file, open(log_path, "w") as log_file:
+        proc = subprocess.Popen(
+            TAP_COMMAND + args,
+            stdout=subprocess.PIPE,
+            stderr=log_file,
+            universal_newlines=True,
+        )
+        for line in proc.stdout:
+            if first_message is None:
+                first_message = time.perf_counter()
+            stdout_file.write(line)
+            head = line[:32]
+            for message_type in ("RECORD", "SCHEMA", "STATE"):
+                if message_type in head:
+                    counts[message_type] = counts.get(message_type, 0) + 1
+                    break
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+    finished = time.perf_counter()
+
+    if proc.returncode != 0:
+        with open(log_path) as log_file:
+            sys.stderr.write(log_file.read()[-4000:])
+        raise Exception("tap exited with {}".format(proc.returncode))
+
+    return {
+        "seconds": finished - started,
+        "startup_seconds": (first_message or finished) - started,
+        "messages": counts,
+        # kilobytes on Linux
+        "peak_rss_mb": usage.ru_maxrss / 1024.0,
+    }
+
+
+def run_tenant(name, spec, options, tap_config, workdir):
+    tenant = Tenant(
+        latency_ms=options.latency_ms,
+        throttle_rate=options.throttle_rate,
+        retry_after=options.retry_after,
+        change_tracking=options.change_tracking or (),
+        **spec
+    )
+    server = start_server(tenant)
+    url = "http://{}:{}".format(*server.server_address)
+
+    config = {
+        "start_date": "2017-09-10",
+        "client_id": "benchmark",
+        "client_secret": "benchmark",
+        "redirect_uri": "http://localhost",
+        "refresh_token": "benchmark",
+        "full_url": url,
+        "token_url": url + "/common/oauth2/token",
+        "get_lookup_tables": True,
+    }
+    config.update(tap_config)
+    config_path = os.path.join(workdir, "{}-config.json".format(name))
+    catalog_path = os.path.join(workdir, "{}-catalog.json".format(name))
+    write_json(config_path, config)
+
+    try:
+        tenant.reset_stats()
+        discovery = run_tap(
+            ["-c", config_path, "--discover"],
+            catalog_path,
+            os.path.join(workdir, "{}-discover.log".format(name)),
+        )
+        discovery["requests"] = tenant.reset_stats()
+        expected = get_expected_records(tenant, select_views(catalog_path))
+
+        sync_args = ["-c", config_path, "--catalog", catalog_path]
+        if options.profile:
+            sync_args.append("--profile")
+        sync = run_tap(
+            sync_args,
+            os.path.join(workdir, "{}-sync.jsonl".format(name)),
+            os.path.join(workdir, "{}-sync.log".format(name)),
+        )
+        sync["requests"] = tenant.reset_stats()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    records = sync["messages"].get("RECORD", 0)
+    if records != expected:
+        raise Exception(
+            "{} tenant: expected {} records, the sync emitted {}".format(
+                name, expected, records
+            )
+        )
+    streaming_seconds = sync["seconds"] - sync["startup_seconds"]
+    sync["records_per_second"] = records / streaming_seconds if streaming_seconds > 0 else 0.0
+    return {"tenant": name, "spec": spec, "discover": discovery, "sync": sync}
+
+
+def print_report(results):
+    header = "{:<8} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10} {:>9} {:>9} {:>6}"
+    row = "{:<8} {:>10.2f} {:>10.2f} {:>10.2f} {:>10d} {:>10.0f} {:>10.1f} {:>9d} {:>9d} {:>6d}"
+    print(
+        header.format(
+            "tenant", "startup s", "discover s", "sync s", "records",
+            "rec/s", "peak MB", "disc reqs", "sync reqs", "429s",
+        )
+    )
+    for result in results:
+        discovery, sync = result["discover"], result["sync"]
+        print(
+            row.format(
+                result["tenant"],
+                sync["startup_seconds"],
+                discovery["seconds"],
+                sync["seconds"],
+                sync["messages"].get("RECORD", 0),
+                sync["records_per_second"],
+                max(discovery["peak_rss_mb"], sync["peak_rss_mb"]),
+                discovery["requests"].get("requests", 0),
+                sync["requests"].get("requests", 0),
+                discovery["requests"].get("throttled", 0)
+                + sync["requests"].get("throttled", 0),
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--tenant", action="append", choices=sorted(TENANTS),
+        help="tenant size to run, repeatable (default: small and medium)",
+    )
+    parser.add_argument("--latency-ms", type=float, default=0, help="delay added to every mock response")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of requests answered with 429")
+    parser.add_argument("--retry-after", type=int, default=0, help="Retry-After seconds sent with each 429")
+    parser.add_argument(
+        "--change-tracking", action="append",
+        help="entity set the mock reports with change tracking enabled, repeatable",
+    )
+    parser.add_argument("--tap-config", help="JSON file merged into the tap config, e.g. to enable raw_json")
+    parser.add_argument("--profile", action="store_true", help="run the sync with --profile")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--keep", action="store_true", help="keep the tap output and logs")
+    options = parser.parse_args()
+
+    tap_config = {}
+    if options.tap_config:
+        with open(options.tap_config) as infile:
+            tap_config = json.load(infile)
+
+    workdir = tempfile.mkdtemp(prefix="tap-dynamics-bench-")
+    results = []
+    for name in options.tenant or ["small", "medium"]:
+        results.append(run_tenant(name, TENANTS[name], options, tap_config, workdir))
+
+    print_report(results)
+    if options.output:
+        write_json(options.output, results)
+    if options.keep:
+        print("Output kept in {}".format(workdir))
+    else:
+        for filename in os.listdir(workdir):
+            os.remove(os.path.join(workdir, filename))
+        os.rmdir(workdir)
+
+
+if __name__ == "__main__":
+    main()
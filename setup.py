@@ -12,9 +12,14 @@ setup(
         "singer-python==5.8.1",
         "odata @ https://github.com/dreamdata-io/python-odata/archive/master.zip",
     ],
+    extras_require={
+        "http2": ["httpx[http2]"],
+        "fast-output": ["orjson"],
+    },
     entry_points="""
           [console_scripts]
           tap-dynamics=tap_dynamics:main
+          tap-dynamics-worker=tap_dynamics.worker:main
       """,
     packages=["tap_dynamics"],
 )
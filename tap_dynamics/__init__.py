@@ -2,14 +2,17 @@
 
 import sys
 import json
-from datetime import datetime, timedelta
 
-import requests
 import singer
 from singer import metadata
 from odata import ODataService
 
-from tap_dynamics.discover import discover
+from tap_dynamics import instrumentation
+from tap_dynamics.auth import DynamicsAuth
+from tap_dynamics.cache import load_metadata_document
+from tap_dynamics.client import WEB_API_PATH, build_session
+from tap_dynamics.discover import discover, read_cached_discovery
+from tap_dynamics.reflection import reflect_service
 from tap_dynamics.sync import sync
 
 LOGGER = singer.get_logger()
@@ -23,7 +26,7 @@ REQUIRED_CONFIG_KEYS = [
 ]
 
 
-def do_discover(service, get_lookup_tables):
+def do_discover(service, get_lookup_tables, config=None, cached=None):
     LOGGER.info("Testing authentication")
     try:
         pass  ## TODO: test authentication
@@ -31,81 +34,69 @@ def do_discover(service, get_lookup_tables):
         raise Exception("Error testing Dynamics authentication")
 
     LOGGER.info("Starting discover")
-    catalog = discover(service, get_lookup_tables)
+    catalog = discover(service, get_lookup_tables, config, cached)
     return catalog
 
 
-class DynamicsAuth(requests.auth.AuthBase):
-    def __init__(self, parsed_args, url):
-        self.__config = parsed_args.config
-        self.__config_path = parsed_args.config_path
-        self.__resource = url
-        self.__client_id = parsed_args.config["client_id"]
-        self.__client_secret = parsed_args.config["client_secret"]
-        self.__redirect_uri = parsed_args.config["redirect_uri"]
-        self.__refresh_token = parsed_args.config["refresh_token"]
-
-        self.__session = requests.Session()
-        self.__access_token = None
-        self.__expires_at = None
-
-    def ensure_access_token(self):
-        if self.__access_token is None or self.__expires_at <= datetime.utcnow():
-            response = self.__session.post(
-                "https://login.microsoftonline.com/common/oauth2/token",
-                data={
-                    "client_id": self.__client_id,
-                    "client_secret": self.__client_secret,
-                    "redirect_uri": self.__redirect_uri,
-                    "refresh_token": self.__refresh_token,
-                    "grant_type": "refresh_token",
-                    "resource": self.__resource,
-                },
-            )
-
-            if response.status_code != 200:
-                raise Exception(response.text)
-
-            data = response.json()
-
-            self.__access_token = data["access_token"]
-            self.__config["refresh_token"] = data["refresh_token"]
-            self.__config["expires_in"] = data["expires_in"]
-            self.__config["access_token"] = data["access_token"]
-
-            with open(self.__config_path, "w") as outfile:
-                json.dump(self.__config, outfile, indent=4)
-
-            self.__expires_at = datetime.utcnow() + timedelta(
-                seconds=int(data["expires_in"]) - 10
-            )  # pad by 10 seconds for clock drift
-
-    def __call__(self, r):
-        self.ensure_access_token()
-        r.headers["Authorization"] = "Bearer {}".format(self.__access_token)
-        return r
+def get_url(config):
+    if config.get('full_url'):
+        return config['full_url']
+    return "https://{}.crm.dynamics.com".format(config["org"])
 
 
-@singer.utils.handle_top_exception(LOGGER)
-def main():
-    parsed_args = singer.utils.parse_args(REQUIRED_CONFIG_KEYS)
-   
-    if parsed_args.config.get('full_url'):
-        url = parsed_args.config['full_url']
-    else:
-        url = "https://{}.crm.dynamics.com".format(parsed_args.config["org"])
-    auth = DynamicsAuth(parsed_args, url)
-    session = requests.Session()
-    session.headers.update({"Prefer": 'odata.include-annotations="*"'})
-    service_url = url + "/api/data/v9.0/"
+def build_service(parsed_args, catalog=None, reflect=True):
+    url = get_url(parsed_args.config)
+    session = build_session(parsed_args.config)
+    auth = DynamicsAuth(parsed_args, url, session)
+    service_url = url + WEB_API_PATH + "v9.0/"
+    # reflect from a cached or narrowed down $metadata document when asked to
+    custom_reflection = parsed_args.config.get(
+        "metadata_cache_dir"
+    ) or parsed_args.config.get("lazy_reflection")
     service = ODataService(
         service_url,
-        reflect_entities=True,
+        reflect_entities=not custom_reflection,
         auth=auth,
         session = session
     )
+    if custom_reflection and reflect:
+        reflect_service(service, parsed_args.config, catalog)
+    return service
+
+
+def build_discovery_service(parsed_args, get_lookup_tables):
+    # with a metadata cache, the catalog cached for the current $metadata
+    # document is checked first and the service is only reflected on a miss
+    config = parsed_args.config
+    service = build_service(parsed_args, reflect=False)
+    document, info = load_metadata_document(service, config)
+    cached = read_cached_discovery(
+        config, service.url, info["hash"], get_lookup_tables
+    )
+    if cached is None:
+        reflect_service(service, config, document=document)
+    return service, cached
+
+
+@singer.utils.handle_top_exception(LOGGER)
+def main():
+    # singer's argument parser doesn't know about --profile
+    profile = "--profile" in sys.argv
+    if profile:
+        sys.argv.remove("--profile")
+    parsed_args = singer.utils.parse_args(REQUIRED_CONFIG_KEYS)
+    if profile or parsed_args.config.get("profile"):
+        instrumentation.enable()
+
     get_lookup_tables = parsed_args.config.get("get_lookup_tables", False)
-    catalog = parsed_args.catalog or do_discover(service, get_lookup_tables)
+    cached = None
+    if parsed_args.discover and parsed_args.config.get("metadata_cache_dir"):
+        service, cached = build_discovery_service(parsed_args, get_lookup_tables)
+    else:
+        service = build_service(parsed_args, parsed_args.catalog)
+    catalog = parsed_args.catalog or do_discover(
+        service, get_lookup_tables, parsed_args.config, cached
+    )
     if parsed_args.discover:
         json.dump(catalog.to_dict(), sys.stdout, indent=2)
 
@@ -115,7 +106,9 @@ def main():
             catalog,
             parsed_args.state,
             parsed_args.config["start_date"],
+            parsed_args.config,
         )
+        instrumentation.report()
 
 
 if __name__ == "__main__":
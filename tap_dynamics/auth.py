@@ -0,0 +1,145 @@
+import json
+import threading
+from datetime import datetime, timedelta
+
+import requests
+import singer
+
+from tap_dynamics.cache import write_atomic
+
+LOGGER = singer.get_logger()
+
+TOKEN_URL = "https://login.microsoftonline.com/common/oauth2/token"
+
+# refresh this long before the access token expires, or after this share of
+# its lifetime for short-lived tokens, but never sooner than the minimum delay
+REFRESH_AHEAD_SECONDS = 300
+REFRESH_AT_FRACTION = 0.8
+MIN_REFRESH_DELAY = 30
+
+# the config fields a token refresh writes back
+TOKEN_FIELDS = ("refresh_token", "access_token", "expires_in")
+
+
+class DynamicsAuth(requests.auth.AuthBase):
+    def __init__(self, parsed_args, url, session=None):
+        self.__config_path = parsed_args.config_path
+        self.__resource = url
+        self.__client_id = parsed_args.config["client_id"]
+        self.__client_secret = parsed_args.config["client_secret"]
+        self.__redirect_uri = parsed_args.config["redirect_uri"]
+        self.__refresh_token = parsed_args.config["refresh_token"]
+        self.__token_url = parsed_args.config.get("token_url", TOKEN_URL)
+
+        self.__session = session or requests.Session()
+        self.__access_token = None
+        self.__expires_at = None
+        # only one refresh may run at a time, the refresh token rotates
+        self.__lock = threading.Lock()
+        self.__persist_lock = threading.Lock()
+        self.__pending_token = None
+        self.__persisting = False
+        self.__refresh_timer = None
+
+    def __is_valid(self):
+        return (
+            self.__access_token is not None
+            and self.__expires_at > datetime.utcnow()
+        )
+
+    def ensure_access_token(self):
+        # requests only wait here on the very first token or when the
+        # background refresh failed to keep the token fresh
+        if self.__is_valid():
+            return
+        with self.__lock:
+            if not self.__is_valid():
+                self.__refresh()
+
+    def __refresh(self):
+        response = self.__session.post(
+            self.__token_url,
+            data={
+                "client_id": self.__client_id,
+                "client_secret": self.__client_secret,
+                "redirect_uri": self.__redirect_uri,
+                "refresh_token": self.__refresh_token,
+                "grant_type": "refresh_token",
+                "resource": self.__resource,
+            },
+        )
+
+        if response.status_code != 200:
+            raise Exception(response.text)
+
+        data = response.json()
+        expires_in = int(data["expires_in"])
+
+        self.__refresh_token = data["refresh_token"]
+        self.__access_token = data["access_token"]
+        self.__expires_at = datetime.utcnow() + timedelta(
+            seconds=expires_in - 10
+        )  # pad by 10 seconds for clock drift
+
+        self.__persist(data)
+        self.__schedule_refresh(
+            max(
+                expires_in - REFRESH_AHEAD_SECONDS,
+                expires_in * REFRESH_AT_FRACTION,
+                MIN_REFRESH_DELAY,
+            )
+        )
+
+    def __schedule_refresh(self, seconds):
+        if self.__refresh_timer is not None:
+            self.__refresh_timer.cancel()
+        self.__refresh_timer = threading.Timer(seconds, self.__refresh_in_background)
+        self.__refresh_timer.daemon = True
+        self.__refresh_timer.start()
+
+    def __refresh_in_background(self):
+        try:
+            with self.__lock:
+                self.__refresh()
+        except Exception as exc:
+            # requests will refresh on their own once the token expires
+            LOGGER.warning("Background token refresh failed: %s", exc)
+
+    def __persist(self, data):
+        # the rotated refresh token is written off the request path by a
+        # single writer that always takes the latest token; the thread is not
+        # a daemon so the write still finishes on exit
+        with self.__persist_lock:
+            self.__pending_token = data
+            if self.__persisting:
+                return
+            self.__persisting = True
+        threading.Thread(target=self.__write_pending).start()
+
+    def __write_pending(self):
+        while True:
+            with self.__persist_lock:
+                data, self.__pending_token = self.__pending_token, None
+                if data is None:
+                    self.__persisting = False
+                    return
+            self.__write_config(data)
+
+    def __write_config(self, data):
+        # only the token fields are replaced, everything else is kept as the
+        # file holds it now, it may have changed since this auth was created
+        config = singer.utils.load_json(self.__config_path)
+        for field in TOKEN_FIELDS:
+            config[field] = data[field]
+        write_atomic(self.__config_path, json.dumps(config, indent=4))
+
+    def close(self):
+        # stops the background refresh, a later request still refreshes the
+        # token on its own once it has expired
+        if self.__refresh_timer is not None:
+            self.__refresh_timer.cancel()
+
+    def __call__(self, r):
+        self.ensure_access_token()
+        r.headers["Authorization"] = "Bearer {}".format(self.__access_token)
+        return r
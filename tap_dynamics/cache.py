@@ -0,0 +1,128 @@
+import hashlib
+import json
+import os
+import time
+
+import singer
+
+from tap_dynamics.client import get_connection
+
+LOGGER = singer.get_logger()
+
+DEFAULT_METADATA_CACHE_TTL = 24 * 60 * 60
+
+
+def get_cache_paths(cache_dir, service_url):
+    key = hashlib.sha1(service_url.encode("utf-8")).hexdigest()
+    return (
+        os.path.join(cache_dir, "{}.xml".format(key)),
+        os.path.join(cache_dir, "{}.json".format(key)),
+    )
+
+
+def get_catalog_cache_path(cache_dir, service_url):
+    key = hashlib.sha1(service_url.encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, "{}.catalog.json".format(key))
+
+
+def read_cache_info(info_path):
+    try:
+        with open(info_path) as infile:
+            return json.load(infile)
+    except (OSError, ValueError):
+        return None
+
+
+def write_atomic(path, data, mode="w"):
+    # the config file holds secrets: the temporary file is only readable by
+    # its owner until it takes over the permissions of the file it replaces
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, mode) as outfile:
+        outfile.write(data)
+    try:
+        os.chmod(tmp_path, os.stat(path).st_mode & 0o7777)
+    except FileNotFoundError:
+        pass
+    os.replace(tmp_path, path)
+
+
+def fetch_metadata_document(service, etag=None):
+    connection = get_connection(service)
+    headers = dict(connection.base_headers)
+    headers["Accept"] = "application/xml"
+    if etag:
+        headers["If-None-Match"] = etag
+
+    response = connection.session.get(
+        service.url + "$metadata",
+        headers=headers,
+        auth=connection.auth,
+        timeout=connection.timeout,
+    )
+    if response.status_code == 304:
+        return None, etag
+    if response.status_code != 200:
+        raise Exception(response.text)
+    return response.content, response.headers.get("ETag")
+
+
+def load_metadata_document(service, config):
+    cache_dir = config["metadata_cache_dir"]
+    ttl = float(config.get("metadata_cache_ttl", DEFAULT_METADATA_CACHE_TTL))
+    force_refresh = config.get("refresh_metadata_cache", False)
+
+    document_path, info_path = get_cache_paths(cache_dir, service.url)
+    info = read_cache_info(info_path)
+    if info is not None and not os.path.exists(document_path):
+        info = None
+
+    if info is not None and not force_refresh:
+        if time.time() - info["fetched_at"] < ttl:
+            LOGGER.info("Using cached metadata document %s", info["hash"])
+            with open(document_path, "rb") as infile:
+                return infile.read(), info
+
+    etag = info.get("etag") if info is not None and not force_refresh else None
+    content, etag = fetch_metadata_document(service, etag)
+
+    if content is None:
+        LOGGER.info("Metadata document not modified, reusing cache")
+        with open(document_path, "rb") as infile:
+            content = infile.read()
+    else:
+        os.makedirs(cache_dir, exist_ok=True)
+        write_atomic(document_path, content, "wb")
+
+    info = {
+        "etag": etag,
+        "hash": hashlib.sha256(content).hexdigest(),
+        "fetched_at": time.time(),
+    }
+    write_atomic(info_path, json.dumps(info))
+    return content, info
+
+
+def get_metadata_hash(config, service_url):
+    # hash of the cached $metadata document the service was reflected from
+    if not config.get("metadata_cache_dir"):
+        return None
+    _, info_path = get_cache_paths(config["metadata_cache_dir"], service_url)
+    info = read_cache_info(info_path)
+    return info["hash"] if info is not None else None
+
+
+def read_catalog_cache(config, service_url, key):
+    cached = read_cache_info(
+        get_catalog_cache_path(config["metadata_cache_dir"], service_url)
+    )
+    if cached is None or cached.pop("key", None) != key:
+        return None
+    return cached
+
+
+def write_catalog_cache(config, service_url, key, cached):
+    write_atomic(
+        get_catalog_cache_path(config["metadata_cache_dir"], service_url),
+        json.dumps(dict(cached, key=key)),
+    )
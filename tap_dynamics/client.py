@@ -0,0 +1,438 @@
+import json
+import queue
+import threading
+import time
+import uuid
+import xml.etree.ElementTree as ET
+from urllib.parse import unquote
+
+import requests
+import singer
+from requests.adapters import HTTPAdapter
+
+from tap_dynamics import instrumentation
+
+LOGGER = singer.get_logger()
+
+# also the most rows the Web API will return in one page
+DEFAULT_PAGE_SIZE = 5000
+
+# every Web API request goes under this path, the token endpoint does not
+WEB_API_PATH = "/api/data/"
+
+
+def get_prefer_header(page_size):
+    return 'odata.include-annotations="*",odata.maxpagesize={}'.format(page_size)
+
+
+# Dynamics service protection limits are per user, 52 concurrent requests
+DEFAULT_MAX_CONCURRENT_REQUESTS = 52
+DEFAULT_THROTTLE_RETRIES = 5
+
+BURST_REMAINING_HEADER = "x-ms-ratelimit-burst-remaining-xrm-requests"
+TIME_REMAINING_HEADER = "x-ms-ratelimit-time-remaining-xrm-requests"
+# start slowing down below these many requests / seconds of execution time
+BURST_REMAINING_LOW = 100
+TIME_REMAINING_LOW = 60
+MAX_PACING_DELAY = 2.0
+
+
+class RequestScheduler(HTTPAdapter):
+    # every request to Dynamics goes through here: concurrency is capped,
+    # 429/503 answers are retried after Retry-After and the rate limit
+    # headers slow everyone down before the limits are hit
+    def __init__(
+        self,
+        max_concurrent_requests=DEFAULT_MAX_CONCURRENT_REQUESTS,
+        throttle_retries=DEFAULT_THROTTLE_RETRIES,
+        **kwargs
+    ):
+        super().__init__(**kwargs)
+        self.throttle_retries = throttle_retries
+        self.throttled_count = 0
+        self.compression_checked = False
+        self.__slots = threading.BoundedSemaphore(max_concurrent_requests)
+        self.__lock = threading.Lock()
+        self.__resume_at = 0.0
+
+    def pause(self, seconds):
+        with self.__lock:
+            self.__resume_at = max(self.__resume_at, time.monotonic() + seconds)
+
+    def wait(self):
+        while True:
+            with self.__lock:
+                delay = self.__resume_at - time.monotonic()
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    def get_retry_after(self, response, attempt):
+        try:
+            return float(response.headers["Retry-After"])
+        except (KeyError, ValueError):
+            return 2 ** attempt
+
+    def get_remaining(self, response, header):
+        # values may carry thousands separators, e.g. "1,200.00"; one that
+        # can't be read just doesn't slow anything down
+        try:
+            return float(response.headers[header].replace(",", ""))
+        except (KeyError, ValueError):
+            return None
+
+    def pace(self, response):
+        delays = []
+        burst_remaining = self.get_remaining(response, BURST_REMAINING_HEADER)
+        if burst_remaining is not None and burst_remaining < BURST_REMAINING_LOW:
+            delays.append(1 - burst_remaining / BURST_REMAINING_LOW)
+        time_remaining = self.get_remaining(response, TIME_REMAINING_HEADER)
+        if time_remaining is not None and time_remaining < TIME_REMAINING_LOW:
+            delays.append(1 - time_remaining / TIME_REMAINING_LOW)
+        if delays:
+            self.pause(max(delays) * MAX_PACING_DELAY)
+
+    def send_request(self, request, **kwargs):
+        return super().send(request, **kwargs)
+
+    def check_compression(self, request, headers):
+        # only Web API data responses, the token response shares the session
+        if self.compression_checked or WEB_API_PATH not in request.url:
+            return
+        if "json" in headers.get("Content-Type", ""):
+            self.compression_checked = True
+            if headers.get("Content-Encoding") not in ("gzip", "deflate", "br"):
+                LOGGER.warning("Dynamics is sending uncompressed JSON responses")
+
+    def send(self, request, **kwargs):
+        for attempt in range(self.throttle_retries + 1):
+            self.wait()
+            with self.__slots:
+                started = time.perf_counter()
+                response = self.send_request(request, **kwargs)
+                instrumentation.record_request(time.perf_counter() - started, response)
+
+            if response.status_code not in (429, 503):
+                break
+            if attempt == self.throttle_retries:
+                instrumentation.record_throttle(retried=False)
+                break
+
+            delay = self.get_retry_after(response, attempt)
+            with self.__lock:
+                self.throttled_count += 1
+            instrumentation.record_throttle(retried=True)
+            LOGGER.warning(
+                "Throttled by Dynamics (%s), retrying in %s seconds",
+                response.status_code,
+                delay,
+            )
+            self.pause(delay)
+            response.close()
+
+        self.pace(response)
+        self.check_compression(request, response.headers)
+        return response
+
+
+class Http2Scheduler(RequestScheduler):
+    # same scheduling, but requests are sent over an httpx client so they can
+    # share HTTP/2 connections
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        try:
+            import httpx
+        except ImportError:
+            raise Exception("http_transport 'http2' requires httpx[http2] to be installed")
+
+        self.__client = httpx.Client(
+            http2=True,
+            limits=httpx.Limits(max_connections=self._pool_maxsize),
+        )
+
+    def send_request(self, request, **kwargs):
+        timeout = kwargs.get("timeout")
+        if isinstance(timeout, tuple):
+            timeout = max(value for value in timeout if value is not None)
+
+        # connection specific headers are not allowed over HTTP/2
+        headers = {
+            name: value
+            for name, value in request.headers.items()
+            if name.lower() != "connection"
+        }
+        http2_response = self.__client.request(
+            request.method,
+            request.url,
+            headers=headers,
+            content=request.body,
+            timeout=timeout,
+        )
+
+        # checked before the encoding header is dropped below
+        self.check_compression(request, http2_response.headers)
+
+        response = requests.Response()
+        response.status_code = http2_response.status_code
+        response.headers = requests.structures.CaseInsensitiveDict(
+            http2_response.headers
+        )
+        # httpx already decoded the body, so requests must not do it again
+        response.headers.pop("Content-Encoding", None)
+        response._content = http2_response.content
+        # there is no raw stream behind the body, close() must not look for one
+        response._content_consumed = True
+        response.encoding = http2_response.encoding
+        response.url = str(http2_response.url)
+        response.reason = http2_response.reason_phrase
+        response.request = request
+        return response
+
+    def close(self):
+        self.__client.close()
+        super().close()
+
+
+HTTP_TRANSPORTS = {
+    "http1": RequestScheduler,
+    "http2": Http2Scheduler,
+}
+
+
+def get_page_size(config):
+    # Dynamics never returns more rows per page than DEFAULT_PAGE_SIZE
+    return min(int(config.get("page_size", DEFAULT_PAGE_SIZE)), DEFAULT_PAGE_SIZE)
+
+
+def get_pool_size(config):
+    if config.get("connection_pool_size"):
+        return int(config["connection_pool_size"])
+
+    # one connection per thread that can be waiting on a response
+    concurrency = int(config.get("max_parallel_streams", 1))
+    if config.get("backfill_window_days"):
+        concurrency *= int(config.get("max_parallel_windows", 4))
+    if int(config.get("prefetch_pages", 0)) > 0:
+        concurrency *= 2
+    max_concurrent_requests = int(
+        config.get("max_concurrent_requests", DEFAULT_MAX_CONCURRENT_REQUESTS)
+    )
+    return max(10, min(concurrency, max_concurrent_requests))
+
+
+def mount_scheduler(session, config):
+    transport = HTTP_TRANSPORTS[config.get("http_transport", "http1")]
+    pool_size = get_pool_size(config)
+    scheduler = transport(
+        max_concurrent_requests=int(
+            config.get("max_concurrent_requests", DEFAULT_MAX_CONCURRENT_REQUESTS)
+        ),
+        throttle_retries=int(config.get("throttle_retries", DEFAULT_THROTTLE_RETRIES)),
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+    )
+    session.mount("https://", scheduler)
+    session.mount("http://", scheduler)
+    return scheduler
+
+
+def build_session(config):
+    # one session for the OData service, the raw requests and token refreshes
+    session = requests.Session()
+    mount_scheduler(session, config)
+    session.headers.update(
+        {
+            "Prefer": get_prefer_header(get_page_size(config)),
+            "Accept-Encoding": "gzip, deflate",
+            "Connection": "keep-alive",
+        }
+    )
+    return session
+
+
+def get_connection(service):
+    return service.default_context.connection
+
+
+def get_json(service, url, params=None, headers=None):
+    connection = get_connection(service)
+    request_headers = dict(connection.base_headers)
+    request_headers.update(headers or {})
+
+    response = connection.session.get(
+        url,
+        params=params,
+        headers=request_headers,
+        auth=connection.auth,
+        timeout=connection.timeout,
+    )
+
+    if response.status_code != 200:
+        raise Exception(response.text)
+
+    return response.json()
+
+
+def iter_responses(service, url, params=None, headers=None):
+    # the nextLink already carries every query option, so params are only
+    # sent with the first request
+    while url:
+        data = get_json(service, url, params, headers)
+        yield data
+        url = data.get("@odata.nextLink")
+        params = None
+
+
+def iter_pages(service, url, params=None, headers=None):
+    for data in iter_responses(service, url, params, headers):
+        yield data.get("value", [])
+
+
+def iter_fetchxml_pages(service, url, fetch, page_size):
+    # FetchXML queries page with page numbers and paging cookies instead of
+    # @odata.nextLink
+    if fetch.get("top"):
+        yield get_json(service, url, {"fetchXml": ET.tostring(fetch, "unicode")}).get(
+            "value", []
+        )
+        return
+
+    fetch.set("count", str(page_size))
+    page_number = 1
+    while True:
+        fetch.set("page", str(page_number))
+        data = get_json(service, url, {"fetchXml": ET.tostring(fetch, "unicode")})
+        yield data.get("value", [])
+
+        if not data.get("@Microsoft.Dynamics.CRM.morerecords"):
+            return
+        cookie = data.get("@Microsoft.Dynamics.CRM.fetchxmlpagingcookie")
+        if cookie:
+            paging_cookie = ET.fromstring(cookie).get("pagingcookie")
+            fetch.set("paging-cookie", unquote(unquote(paging_cookie)))
+        page_number += 1
+
+
+def format_batch_request(url, headers):
+    lines = ["GET {} HTTP/1.1".format(url)]
+    lines += ["{}: {}".format(name, value) for name, value in headers.items()]
+    return "\r\n".join(lines) + "\r\n\r\n"
+
+
+def parse_batch_response(response):
+    content_type = response.headers.get("Content-Type", "")
+    boundary = content_type.split("boundary=")[1].split(";")[0].strip().strip('"')
+
+    results = []
+    for part in response.text.split("--" + boundary)[1:]:
+        if part.startswith("--"):
+            break
+        # each part is a MIME header block followed by a full HTTP response
+        _, _, http_response = part.partition("\r\n\r\n")
+        status_line, _, http_response = http_response.partition("\r\n")
+        _, _, body = http_response.partition("\r\n\r\n")
+        if int(status_line.split(" ")[1]) != 200:
+            raise Exception(body)
+        results.append(json.loads(body) if body.strip() else {})
+    return results
+
+
+def batch_get(service, urls):
+    # send independent GET requests in one $batch round trip, results come
+    # back in the order of `urls`
+    connection = get_connection(service)
+    boundary = "batch_{}".format(uuid.uuid4().hex)
+
+    part_headers = {"Accept": "application/json"}
+    if connection.session.headers.get("Prefer"):
+        part_headers["Prefer"] = connection.session.headers["Prefer"]
+
+    body = ""
+    for url in urls:
+        body += "--{}\r\n".format(boundary)
+        body += "Content-Type: application/http\r\n"
+        body += "Content-Transfer-Encoding: binary\r\n\r\n"
+        body += format_batch_request(url, part_headers)
+    body += "--{}--\r\n".format(boundary)
+
+    headers = dict(connection.base_headers)
+    headers["Content-Type"] = "multipart/mixed; boundary={}".format(boundary)
+    response = connection.session.post(
+        service.url + "$batch",
+        data=body.encode("utf-8"),
+        headers=headers,
+        auth=connection.auth,
+        timeout=connection.timeout,
+    )
+
+    if response.status_code != 200:
+        raise Exception(response.text)
+
+    return parse_batch_response(response)
+
+
+def batch_get_values(service, urls):
+    results = []
+    for data in batch_get(service, urls):
+        rows = list(data.get("value", []))
+        if data.get("@odata.nextLink"):
+            for page in iter_pages(service, data["@odata.nextLink"]):
+                rows.extend(page)
+        results.append(rows)
+    return results
+
+
+class PrefetchError:
+    def __init__(self, exc):
+        self.exc = exc
+
+
+PREFETCH_DONE = object()
+
+
+def maybe_prefetch(pages, config):
+    prefetch_pages = int(config.get("prefetch_pages", 0))
+    if prefetch_pages > 0:
+        return prefetch(pages, prefetch_pages)
+    return pages
+
+
+def prefetch(pages, depth):
+    # fetch pages on a background thread while the caller serializes the
+    # previous ones, at most `depth` pages wait in the queue
+    buffer = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    stream_name = instrumentation.current_stream_name()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def fetch():
+        try:
+            with instrumentation.stream_context(stream_name):
+                for page in pages:
+                    if not put(page):
+                        return
+            put(PREFETCH_DONE)
+        except Exception as exc:
+            put(PrefetchError(exc))
+
+    fetcher = threading.Thread(target=fetch, daemon=True)
+    fetcher.start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is PREFETCH_DONE:
+                return
+            if isinstance(item, PrefetchError):
+                raise item.exc
+            yield item
+    finally:
+        # also stops the fetcher when the consumer gives up early
+        stop.set()
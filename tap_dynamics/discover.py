@@ -1,8 +1,88 @@
+import hashlib
+import json
+from urllib.parse import quote, urlencode
 
+import singer
 from singer.catalog import Catalog, CatalogEntry, Schema
 from odata import ODataService
 from odata.navproperty import NavigationProperty
 
+from tap_dynamics.cache import get_metadata_hash, read_catalog_cache, write_catalog_cache
+from tap_dynamics.client import batch_get_values, iter_pages
+
+LOGGER = singer.get_logger()
+
+SELECTED_TABLES = [
+    "accounts",
+    "campaigns",
+    "leads",
+    "savedqueries",
+    "userqueries",
+    "opportunities",
+    "contacts",
+    "transactioncurrencies",
+    "salesorders",
+    "systemusers",
+    "msdyncrm_linkedinaccounts",
+    "msdyncrm_linkedinactivities",
+    "msdyncrm_linkedincampaigns",
+    "msdyncrm_linkedinconfigurations",
+    "msdyncrm_linkedinfieldmappings",
+    "msdyncrm_linkedinformanswers",
+    "msdyncrm_linkedinformquestions",
+    "msdyncrm_linkedinforms",
+    "msdyncrm_linkedinformsubmissions",
+    "msdyncrm_linkedinleadmatchingstrategies",
+    "msdyncrm_linkedinuserprofile_accountset",
+    "msdyncrm_linkedinuserprofiles",
+    "msdyncrm_msdyncrm_linkedinlms_fieldmappingset",
+]
+
+# part of the catalog cache key, bump it whenever discovery builds different
+# schemas or cache entries from the same $metadata document
+CATALOG_CACHE_VERSION = 2
+
+# marks rows removed since the last change tracking sync
+DELETED_AT_FIELD = "_sdc_deleted_at"
+
+# view streams are synced through the entity set their views return
+VIEW_STREAMS = {
+    "view_leads": "leads",
+    "view_personal_leads": "leads",
+    "view_contacts": "contacts",
+    "view_personal_contacts": "contacts",
+}
+
+# (view entity, returnedtypecode) queried to discover each view stream
+VIEW_QUERIES = {
+    "view_leads": ("savedqueries", "lead"),
+    "view_personal_leads": ("userqueries", "lead"),
+    "view_contacts": ("savedqueries", "contact"),
+    "view_personal_contacts": ("userqueries", "contact"),
+}
+
+VIEW_ID_FIELDS = {"savedqueries": "savedqueryid", "userqueries": "userqueryid"}
+
+
+def is_lookup_table(entity_name):
+    return "lkup" in entity_name
+
+
+# JSON schema for each Edm type, anything not listed is read as a string
+EDM_TYPES = {
+    "Edm.Date": {"type": ["null", "string"], "format": "date-time"},
+    "Edm.DateTime": {"type": ["null", "string"], "format": "date-time"},
+    "Edm.DateTimeOffset": {"type": ["null", "string"], "format": "date-time"},
+    "Edm.Int16": {"type": ["null", "integer"]},
+    "Edm.Int32": {"type": ["null", "integer"]},
+    "Edm.Int64": {"type": ["null", "integer"]},
+    "Edm.Double": {"type": ["null", "number"]},
+    "Edm.Decimal": {"type": ["null", "number"]},
+    "Edm.Boolean": {"type": ["null", "boolean"]},
+}
+
+DEFAULT_PROPERTY_SCHEMA = {"type": ["null", "string"]}
+
 
 def get_schema(entity):
     odata_schema = entity.__odata_schema__
@@ -10,37 +90,20 @@ def get_schema(entity):
     metadata = []
     pks = []
     for odata_prop in odata_schema.get("properties", []):
-        odata_type = odata_prop["type"]
         prop_name = odata_prop["name"]
-        json_type = "string"
-        json_format = None
-
-        inclusion = "available"
         if odata_prop["is_primary_key"] == True:
             pks.append(prop_name)
 
         metadata.append(
             {
                 "breadcrumb": ["properties", prop_name],
-                "metadata": {"inclusion": inclusion},
+                "metadata": {"inclusion": "available"},
             }
         )
-
-        if odata_type in ["Edm.Date", "Edm.DateTime", "Edm.DateTimeOffset"]:
-            json_format = "date-time"
-        elif odata_type in ["Edm.Int16", "Edm.Int32", "Edm.Int64"]:
-            json_type = "integer"
-        elif odata_type in ["Edm.Double", "Edm.Decimal"]:
-            json_type = "number"
-        elif odata_type == "Edm.Boolean":
-            json_type = "boolean"
-        
-        prop_json_schema = {"type": ["null", json_type]}
-
-        if json_format:
-            prop_json_schema["format"] = json_format
-
-        json_props[prop_name] = prop_json_schema
+        prop_json_schema = EDM_TYPES.get(odata_prop["type"], DEFAULT_PROPERTY_SCHEMA)
+        json_props[prop_name] = dict(
+            prop_json_schema, type=list(prop_json_schema["type"])
+        )
 
     json_schema = {
         "type": "object",
@@ -60,47 +123,108 @@ def get_navigation_properties(entity):
     return navigation_properties
 
 
-def discover(service, get_lookup_tables):
-    catalog = Catalog([])
-    selected_tables = [
-        "accounts",
-        "campaigns",
-        "leads",
-        "savedqueries",
-        "userqueries",
-        "opportunities",
-        "contacts",
-        "transactioncurrencies",
-        "salesorders",
-        "systemusers",
-        "msdyncrm_linkedinaccounts",
-        "msdyncrm_linkedinactivities",
-        "msdyncrm_linkedincampaigns",
-        "msdyncrm_linkedinconfigurations",
-        "msdyncrm_linkedinfieldmappings",
-        "msdyncrm_linkedinformanswers",
-        "msdyncrm_linkedinformquestions",
-        "msdyncrm_linkedinforms",
-        "msdyncrm_linkedinformsubmissions",
-        "msdyncrm_linkedinleadmatchingstrategies",
-        "msdyncrm_linkedinuserprofile_accountset",
-        "msdyncrm_linkedinuserprofiles",
-        "msdyncrm_msdyncrm_linkedinlms_fieldmappingset",
-    ]
+def get_change_tracking_tables(service):
+    params = {
+        "$select": "EntitySetName,ChangeTrackingEnabled",
+        "$filter": "ChangeTrackingEnabled eq true",
+    }
+    try:
+        return {
+            definition["EntitySetName"]
+            for page in iter_pages(service, service.url + "EntityDefinitions", params)
+            for definition in page
+        }
+    except Exception:
+        LOGGER.info("Could not read entity definitions, change tracking disabled")
+        return set()
 
 
-    if get_lookup_tables:
-        extra_tables = []
-        for entity_name in service.entities.keys():
-            if "lkup" in entity_name:
-                extra_tables.append(entity_name)
-        
-        selected_tables += extra_tables
-                    
-    for entity_name, entity in service.entities.items():
-        if entity_name not in selected_tables:
-            continue
-        schema_dict, metadata, pks = get_schema(entity)
+def get_catalog_cache_key(metadata_hash, get_lookup_tables):
+    if metadata_hash is None:
+        return None
+    key = [CATALOG_CACHE_VERSION, metadata_hash, get_lookup_tables, SELECTED_TABLES]
+    return hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()
+
+
+def read_cached_discovery(config, service_url, metadata_hash, get_lookup_tables):
+    # usable before the service is reflected, the entry holds everything
+    # discovery needs from the reflected entities
+    cache_key = get_catalog_cache_key(metadata_hash, get_lookup_tables)
+    cached = read_catalog_cache(config, service_url, cache_key)
+    if cached is not None:
+        LOGGER.info("Using cached table schemas for %s tables", len(cached["tables"]))
+    return cached
+
+
+def get_table_schemas(service, get_lookup_tables):
+    # a single pass over the reflected entities, schemas are only built for
+    # the tables that end up in the catalog
+    selected_tables = set(SELECTED_TABLES)
+    return {
+        entity_name: get_schema(entity)
+        for entity_name, entity in service.entities.items()
+        if entity_name in selected_tables
+        or (get_lookup_tables and is_lookup_table(entity_name))
+    }
+
+
+def get_view_entity_sets(service):
+    return sorted(
+        {
+            VIEW_STREAMS[stream_name]
+            for stream_name in VIEW_QUERIES
+            if VIEW_STREAMS[stream_name] in service.entities
+        }
+    )
+
+
+def load_table_schemas(service, get_lookup_tables, config):
+    # the table schemas only change with the $metadata document, so they are
+    # cached next to it and keyed by its hash
+    metadata_hash = get_metadata_hash(config, service.url)
+    cache_key = get_catalog_cache_key(metadata_hash, get_lookup_tables)
+    if cache_key is not None:
+        cached = read_cached_discovery(
+            config, service.url, metadata_hash, get_lookup_tables
+        )
+        if cached is not None:
+            return cached
+
+    cached = {
+        "tables": get_table_schemas(service, get_lookup_tables),
+        "view_entity_sets": get_view_entity_sets(service),
+    }
+    if cache_key is not None:
+        write_catalog_cache(config, service.url, cache_key, cached)
+    return cached
+
+
+def discover(service, get_lookup_tables, config=None, cached=None):
+    # `cached` is a catalog cache entry read before the service was reflected,
+    # without one the schemas come from the reflected entities
+    config = config or {}
+    catalog = Catalog([])
+    cached = cached or load_table_schemas(service, get_lookup_tables, config)
+    tables = cached["tables"]
+    change_tracking_tables = get_change_tracking_tables(service)
+
+    for entity_name, (schema_dict, metadata, pks) in tables.items():
+        if entity_name in change_tracking_tables:
+            replication_method = "CHANGE_TRACKING"
+            schema_dict["properties"][DELETED_AT_FIELD] = {
+                "type": ["null", "string"],
+                "format": "date-time",
+            }
+            metadata.append(
+                {
+                    "breadcrumb": ["properties", DELETED_AT_FIELD],
+                    "metadata": {"inclusion": "automatic"},
+                }
+            )
+        elif schema_dict.get("properties", None).get("createdon", None):
+            replication_method = "INCREMENTAL"
+        else:
+            replication_method = "FULL_TABLE"
         metadata.append({"breadcrumb": [], "metadata": {"selected": True}})
         schema = Schema.from_dict(schema_dict)
         catalog.streams.append(
@@ -110,74 +234,47 @@ def discover(service, get_lookup_tables):
                 key_properties=pks,
                 schema=schema,
                 metadata=metadata,
-                replication_method="INCREMENTAL"
-                if schema_dict.get("properties", None).get("createdon", None)
-                else "FULL_TABLE",
+                replication_method=replication_method,
             )
         )
-    
 
-    if "leads" in service.entities:
-        view_leads_data = get_view_by_service('savedqueries','lead',service) 
-        if len(view_leads_data) > 0 : 
+    view_streams = [
+        stream_name
+        for stream_name in VIEW_QUERIES
+        if VIEW_STREAMS[stream_name] in cached["view_entity_sets"]
+    ]
+    views_data = get_views_by_service(
+        service, [VIEW_QUERIES[stream_name] for stream_name in view_streams]
+    )
+    for stream_name, view_data in zip(view_streams, views_data):
+        if len(view_data) > 0:
+            view_type = "system" if VIEW_QUERIES[stream_name][0] == "savedqueries" else "personal"
             catalog.streams.append(
-                    CatalogEntry(
-                        stream="view_leads",
-                        tap_stream_id="view_leads",
-                        key_properties=None,
-                        schema=create_views_schema('view_leads',view_leads_data),
-                        metadata=create_metadata_views('system',view_leads_data),
-                    )
+                CatalogEntry(
+                    stream=stream_name,
+                    tap_stream_id=stream_name,
+                    key_properties=None,
+                    schema=create_views_schema(stream_name, view_data),
+                    metadata=create_metadata_views(view_type, view_data),
                 )
-        view_personal_leads_data = get_view_by_service('userqueries','lead',service) 
-        if len(view_personal_leads_data) > 0 : 
-            catalog.streams.append(
-                    CatalogEntry(
-                        stream="view_personal_leads",
-                        tap_stream_id="view_personal_leads",
-                        key_properties=None,
-                        schema=create_views_schema('view_personal_leads',view_personal_leads_data),
-                        metadata=create_metadata_views('personal',view_personal_leads_data),
-                    )
             )
-    
-    if "contacts" in service.entities:
-        view_contacts_data = get_view_by_service('savedqueries','contact',service)
-        if len(view_contacts_data) > 0 : 
-            catalog.streams.append(
-                    CatalogEntry(
-                        stream="view_contacts",
-                        tap_stream_id="view_contacts",
-                        key_properties=None,
-                        schema=create_views_schema('view_contacts',view_contacts_data),
-                        metadata=create_metadata_views('system',view_contacts_data),
-                    )
-                )
-        view_personal_contacts_data = get_view_by_service('userqueries','contact',service) 
-        if len(view_personal_contacts_data) > 0:
-            catalog.streams.append(
-                    CatalogEntry(
-                        stream="view_personal_contacts",
-                        tap_stream_id="view_personal_contacts",
-                        key_properties=None,
-                        schema=create_views_schema('view_personal_contacts',view_personal_contacts_data),
-                        metadata=create_metadata_views('personal',view_personal_contacts_data),
-                    )
-                )
-        
+
     return catalog
 
 
-def get_view_by_service(entity, name, service):
- 
-    view = service.entities[entity]
-    query = service.query(view)
-    query = query.filter(f"returnedtypecode eq '{name}'")
-    array_items = []
-    for item in query:
-        array_items.append(item)
+def get_views_by_service(service, view_queries):
+    # all view lookups go out in a single $batch request
+    urls = []
+    for entity, name in view_queries:
+        params = {
+            "$select": ",".join(["name", VIEW_ID_FIELDS[entity], "returnedtypecode"]),
+            "$filter": f"returnedtypecode eq '{name}'",
+        }
+        urls.append(service.url + entity + "?" + urlencode(params, safe="$,'", quote_via=quote))
 
-    return array_items
+    if not urls:
+        return []
+    return batch_get_values(service, urls)
 
 def clean_view_name(name):
     return name.replace(' ', '-').replace(':', '-')
@@ -194,7 +291,7 @@ def create_views_schema(view_name,array_views):
     }
 
     for item in array_views:
-        schema["properties"][clean_view_name(item.name)] = {
+        schema["properties"][clean_view_name(item["name"])] = {
           "type": ["null", "string"]
         }
     
@@ -213,15 +310,15 @@ def create_metadata_views(view_type,array_views):
         if view_type == 'system':
             metadata.append(
                 {
-                    "breadcrumb": ["properties", clean_view_name(item.name)],          
-                    "metadata": {"inclusion": "available", "view_id": item.savedqueryid,},
+                    "breadcrumb": ["properties", clean_view_name(item["name"])],          
+                    "metadata": {"inclusion": "available", "view_id": item["savedqueryid"],},
                 } 
             )
         elif view_type == 'personal':
             metadata.append(
                 {
-                    "breadcrumb": ["properties", clean_view_name(item.name)],          
-                    "metadata": {"inclusion": "available", "view_id": item.userqueryid,},
+                    "breadcrumb": ["properties", clean_view_name(item["name"])],          
+                    "metadata": {"inclusion": "available", "view_id": item["userqueryid"],},
                 } 
             )
 
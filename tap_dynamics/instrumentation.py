@@ -0,0 +1,237 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import singer
+from singer import metrics
+
+LOGGER = singer.get_logger()
+
+STAGES = ["fetch", "transform", "write"]
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, int(round(pct / 100.0 * len(ordered))) - 1)
+    return ordered[index]
+
+
+class StreamProfile:
+    def __init__(self, stream_name):
+        self.stream_name = stream_name
+        self.started = time.monotonic()
+        self.finished = None
+        self.latencies = []
+        self.bytes_received = 0
+        self.records = 0
+        self.pages = 0
+        self.throttled = 0
+        self.retries = 0
+        self.stage_times = {stage: 0.0 for stage in STAGES}
+
+    @property
+    def duration(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def records_per_second(self):
+        return self.records / self.duration if self.duration > 0 else 0.0
+
+
+class Profiler:
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+        self.streams = {}
+
+    def get_stream(self, stream_name):
+        with self.__lock:
+            if stream_name not in self.streams:
+                self.streams[stream_name] = StreamProfile(stream_name)
+            return self.streams[stream_name]
+
+    def current_stream(self):
+        return getattr(self.__local, "stream", None)
+
+    @contextmanager
+    def stream_context(self, stream_name):
+        previous = self.current_stream()
+        self.__local.stream = self.get_stream(stream_name)
+        try:
+            yield self.__local.stream
+        finally:
+            self.__local.stream = previous
+
+    def record_request(self, latency, bytes_received):
+        profile = self.current_stream()
+        if profile is None:
+            return
+        with self.__lock:
+            profile.latencies.append(latency)
+            profile.bytes_received += bytes_received
+
+    def record_throttle(self, retried):
+        profile = self.current_stream()
+        if profile is None:
+            return
+        with self.__lock:
+            profile.throttled += 1
+            if retried:
+                profile.retries += 1
+
+    def record_page(self, stream_name, records, **stage_times):
+        profile = self.get_stream(stream_name)
+        with self.__lock:
+            profile.pages += 1
+            profile.records += records
+            for stage, seconds in stage_times.items():
+                profile.stage_times[stage] += seconds
+        metrics.log(
+            LOGGER,
+            metrics.Point(
+                "timer",
+                "page_duration",
+                sum(stage_times.values()),
+                {"endpoint": stream_name, "records": records},
+            ),
+        )
+
+    def finish_stream(self, stream_name):
+        profile = self.get_stream(stream_name)
+        profile.finished = time.monotonic()
+        for point in get_stream_points(profile):
+            metrics.log(LOGGER, point)
+
+    def report(self):
+        LOGGER.info("Performance report")
+        LOGGER.info(
+            "%-40s %9s %7s %10s %9s %9s %9s %9s %9s %9s %9s %6s",
+            "stream",
+            "records",
+            "pages",
+            "rec/s",
+            "MB",
+            "p50 ms",
+            "p95 ms",
+            "p99 ms",
+            "fetch s",
+            "xform s",
+            "write s",
+            "429s",
+        )
+        for profile in self.streams.values():
+            LOGGER.info(
+                "%-40s %9d %7d %10.1f %9.2f %9s %9s %9s %9.2f %9.2f %9.2f %6d",
+                profile.stream_name[:40],
+                profile.records,
+                profile.pages,
+                profile.records_per_second,
+                profile.bytes_received / 1024.0 / 1024.0,
+                format_ms(percentile(profile.latencies, 50)),
+                format_ms(percentile(profile.latencies, 95)),
+                format_ms(percentile(profile.latencies, 99)),
+                profile.stage_times["fetch"],
+                profile.stage_times["transform"],
+                profile.stage_times["write"],
+                profile.throttled,
+            )
+
+
+def format_ms(seconds):
+    return "-" if seconds is None else "{:.0f}".format(seconds * 1000)
+
+
+def get_stream_points(profile):
+    tags = {"endpoint": profile.stream_name}
+    points = [
+        metrics.Point("counter", "bytes_received", profile.bytes_received, tags),
+        metrics.Point("counter", "http_request_count", len(profile.latencies), tags),
+        metrics.Point("counter", "throttle_count", profile.throttled, tags),
+        metrics.Point("counter", "retry_count", profile.retries, tags),
+        metrics.Point("timer", "records_per_second", profile.records_per_second, tags),
+    ]
+    for pct in (50, 95, 99):
+        latency = percentile(profile.latencies, pct)
+        if latency is not None:
+            points.append(
+                metrics.Point(
+                    "timer",
+                    "http_request_duration",
+                    latency,
+                    dict(tags, percentile=pct),
+                )
+            )
+    for stage, seconds in profile.stage_times.items():
+        points.append(metrics.Point("timer", "{}_duration".format(stage), seconds, tags))
+    return points
+
+
+# None until profiling is enabled, every hook below is then a no-op
+PROFILER = None
+
+
+def enable():
+    global PROFILER
+    PROFILER = Profiler()
+
+
+def disable():
+    global PROFILER
+    PROFILER = None
+
+
+def current_stream_name():
+    if PROFILER is None or PROFILER.current_stream() is None:
+        return None
+    return PROFILER.current_stream().stream_name
+
+
+@contextmanager
+def stream_context(stream_name):
+    if PROFILER is None or stream_name is None:
+        yield
+        return
+    with PROFILER.stream_context(stream_name):
+        yield
+
+
+def record_request(latency, response):
+    if PROFILER is None:
+        return
+    # always the decoded body: Content-Length is the compressed size and is
+    # missing from chunked responses, and HTTP/2 responses have no raw stream
+    PROFILER.record_request(latency, len(response.content))
+
+
+def record_throttle(retried):
+    if PROFILER is not None:
+        PROFILER.record_throttle(retried)
+
+
+def record_page(stream_name, records, **stage_times):
+    if PROFILER is not None:
+        PROFILER.record_page(stream_name, records, **stage_times)
+
+
+def finish_stream(stream_name):
+    if PROFILER is not None:
+        PROFILER.finish_stream(stream_name)
+
+
+def report():
+    if PROFILER is not None:
+        PROFILER.report()
+
+
+def timed(pages):
+    # pairs every page with the time spent waiting for it
+    pages = iter(pages)
+    while True:
+        started = time.perf_counter()
+        try:
+            page = next(pages)
+        except StopIteration:
+            return
+        yield page, time.perf_counter() - started
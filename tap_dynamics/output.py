@@ -0,0 +1,117 @@
+import decimal
+import json
+import sys
+import threading
+
+import singer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# every message goes through this lock so that streams synced in parallel
+# never interleave partial lines or write a state that is being mutated
+WRITE_LOCK = threading.RLock()
+
+DEFAULT_OUTPUT_BUFFER_SIZE = 1024 * 1024
+
+
+def default_encoder(value):
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    raise TypeError("{} is not JSON serializable".format(type(value).__name__))
+
+
+def dumps(message):
+    if orjson is not None:
+        return orjson.dumps(message, default=default_encoder)
+    return json.dumps(
+        message, default=default_encoder, separators=(",", ":")
+    ).encode("utf-8")
+
+
+class MessageWriter:
+    # same messages as singer.write_*, but encoded with orjson when it is
+    # installed and written to stdout in large blocks
+    def __init__(self, out=None, buffer_size=DEFAULT_OUTPUT_BUFFER_SIZE):
+        self.out = out or sys.stdout
+        self.buffer_size = buffer_size
+        self.__buffer = []
+        self.__buffered = 0
+
+    def write_message(self, message, flush=False):
+        line = dumps(message) + b"\n"
+        with WRITE_LOCK:
+            self.__buffer.append(line)
+            self.__buffered += len(line)
+            if flush or self.__buffered >= self.buffer_size:
+                self.flush()
+
+    def flush(self):
+        with WRITE_LOCK:
+            if not self.__buffer:
+                return
+            # anything written through the text layer has to go out first
+            self.out.flush()
+            self.out.buffer.write(b"".join(self.__buffer))
+            self.out.buffer.flush()
+            self.__buffer = []
+            self.__buffered = 0
+
+
+WRITER = None
+
+
+def configure(config):
+    global WRITER
+    if config.get("fast_output"):
+        WRITER = MessageWriter(
+            buffer_size=int(
+                config.get("output_buffer_size", DEFAULT_OUTPUT_BUFFER_SIZE)
+            )
+        )
+    else:
+        WRITER = None
+
+
+def write_record(stream_name, record):
+    if WRITER is None:
+        with WRITE_LOCK:
+            singer.write_record(stream_name, record)
+        return
+
+    WRITER.write_message({"type": "RECORD", "stream": stream_name, "record": record})
+
+
+def write_schema(stream_name, schema, key_properties):
+    if WRITER is None:
+        with WRITE_LOCK:
+            singer.write_schema(stream_name, schema, key_properties)
+        return
+
+    if isinstance(key_properties, (str, bytes)):
+        key_properties = [key_properties]
+    WRITER.write_message(
+        {
+            "type": "SCHEMA",
+            "stream": stream_name,
+            "schema": schema,
+            "key_properties": key_properties,
+        }
+    )
+
+
+def write_state(value):
+    if WRITER is None:
+        with WRITE_LOCK:
+            singer.write_state(value)
+        return
+
+    # flushing with the state keeps every record it covers ahead of it
+    WRITER.write_message({"type": "STATE", "value": value}, flush=True)
+
+
+def flush():
+    if WRITER is not None:
+        WRITER.flush()
@@ -0,0 +1,141 @@
+import xml.etree.ElementTree as ET
+
+import singer
+from odata import metadata as odata_metadata
+
+from tap_dynamics.cache import fetch_metadata_document, load_metadata_document
+from tap_dynamics.discover import SELECTED_TABLES, VIEW_STREAMS, is_lookup_table
+
+LOGGER = singer.get_logger()
+
+EDM = "{http://docs.oasis-open.org/odata/ns/edm}"
+
+
+def get_entity_set_names(root):
+    return [
+        entity_set.get("Name") for entity_set in root.iter(EDM + "EntitySet")
+    ]
+
+
+def get_required_entity_sets(root, catalog, get_lookup_tables):
+    if catalog:
+        return {
+            VIEW_STREAMS.get(stream.tap_stream_id, stream.tap_stream_id)
+            for stream in catalog.streams
+            if stream.is_selected()
+        }
+
+    required = set(SELECTED_TABLES)
+    if get_lookup_tables:
+        required.update(
+            name for name in get_entity_set_names(root) if is_lookup_table(name)
+        )
+    return required
+
+
+def get_type_name(type_name):
+    if type_name.startswith("Collection(") and type_name.endswith(")"):
+        return type_name[len("Collection(") : -1]
+    return type_name
+
+
+def prune_metadata_document(root, entity_sets):
+    # keep only the entity sets we need, the entity types behind them with
+    # their base types, and the navigation properties between those types
+    entity_types = {}
+    for schema in root.iter(EDM + "Schema"):
+        prefixes = [schema.get("Namespace"), schema.get("Alias")]
+        for entity_type in schema.findall(EDM + "EntityType"):
+            for prefix in prefixes:
+                if prefix:
+                    entity_types[prefix + "." + entity_type.get("Name")] = entity_type
+
+    kept_types = set()
+    pending = []
+    for container in root.iter(EDM + "EntityContainer"):
+        for child in list(container):
+            if child.tag == EDM + "EntitySet" and child.get("Name") in entity_sets:
+                pending.append(child.get("EntityType"))
+            else:
+                container.remove(child)
+
+    while pending:
+        entity_type = entity_types.get(pending.pop())
+        if entity_type is None or id(entity_type) in kept_types:
+            continue
+        kept_types.add(id(entity_type))
+        if entity_type.get("BaseType"):
+            pending.append(entity_type.get("BaseType"))
+
+    for schema in root.iter(EDM + "Schema"):
+        for child in list(schema):
+            if child.tag in (EDM + "Action", EDM + "Function"):
+                schema.remove(child)
+            elif child.tag == EDM + "EntityType" and id(child) not in kept_types:
+                schema.remove(child)
+
+    kept_names = {
+        name
+        for name, entity_type in entity_types.items()
+        if id(entity_type) in kept_types
+    }
+    for entity_type in entity_types.values():
+        if id(entity_type) not in kept_types:
+            continue
+        for nav in entity_type.findall(EDM + "NavigationProperty"):
+            if get_type_name(nav.get("Type", "")) not in kept_names:
+                entity_type.remove(nav)
+
+    for entity_set in root.iter(EDM + "EntitySet"):
+        for binding in entity_set.findall(EDM + "NavigationPropertyBinding"):
+            if binding.get("Target") not in entity_sets:
+                entity_set.remove(binding)
+
+    LOGGER.info(
+        "Reflecting %s entity sets (%s entity types)", len(entity_sets), len(kept_types)
+    )
+    return root
+
+
+def reflect_entities(service, document, entity_sets=None):
+    # the generated entity classes can't be stored, so they are rebuilt from
+    # the document, optionally narrowed down to the entity sets we need
+    if entity_sets is not None:
+        root = document if isinstance(document, ET.Element) else ET.fromstring(document)
+        document = prune_metadata_document(root, entity_sets)
+    if isinstance(document, ET.Element):
+        document = ET.tostring(document)
+
+    # python-odata queries the tree with its own ElementTree flavour (lxml
+    # when it is installed), so it has to parse the document itself
+    root = odata_metadata.ET.fromstring(document)
+    service.metadata.load_document = lambda: root
+    reflected = service.metadata.get_entity_sets(base=service.Base)
+    if len(reflected) == 4:
+        (
+            service.entities,
+            service.types,
+            service.actions,
+            service.functions,
+        ) = reflected
+    else:
+        # newer python-odata releases return (base, entities, types)
+        _, service.entities, service.types = reflected
+    return service
+
+
+def reflect_service(service, config, catalog=None, document=None):
+    # the document may already have been loaded by the caller
+    if document is None and config.get("metadata_cache_dir"):
+        document, _ = load_metadata_document(service, config)
+    elif document is None:
+        document, _ = fetch_metadata_document(service)
+
+    if not config.get("lazy_reflection"):
+        return reflect_entities(service, document)
+
+    root = ET.fromstring(document)
+    entity_sets = get_required_entity_sets(
+        root, catalog, config.get("get_lookup_tables", False)
+    )
+    return reflect_entities(service, root, entity_sets)
@@ -1,33 +1,265 @@
-from datetime import datetime
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import quote, urlencode
+import hashlib
+import itertools
+import json
+import re
+import time
+import xml.etree.ElementTree as ET
 
 import singer
 from singer import metrics, metadata, Transformer
 from singer.bookmarks import set_currently_syncing
 from datetime import timedelta
-from tap_dynamics.discover import discover
+from tap_dynamics import client, instrumentation, output
+from tap_dynamics.discover import DELETED_AT_FIELD, discover, is_lookup_table
+from tap_dynamics.output import WRITE_LOCK
+from tap_dynamics.transform import build_coercers, coerce_record
 
 LOGGER = singer.get_logger()
 
 MODIFIED_DATE_FIELD = "modifiedon"
 
+CHANGE_TRACKING = "CHANGE_TRACKING"
+
+DATETIME_TYPES = {"Edm.Date", "Edm.DateTime", "Edm.DateTimeOffset"}
+
+DEFAULT_LOOKUP_BATCH_SIZE = 100
+
+GUID_PATTERN = re.compile(
+    r"^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$"
+)
+
 
 def get_bookmark(state, stream_name, default):
     return state.get("bookmarks", {}).get(stream_name, default)
 
 
 def write_bookmark(state, stream_name, value):
-    if "bookmarks" not in state:
-        state["bookmarks"] = {}
-    state["bookmarks"][stream_name] = value
-    singer.write_state(state)
+    with WRITE_LOCK:
+        if "bookmarks" not in state:
+            state["bookmarks"] = {}
+        state["bookmarks"][stream_name] = value
+        output.write_state(state)
+
+
+def write_bookmarks(state, bookmarks):
+    # several streams checkpointed with a single STATE message
+    with WRITE_LOCK:
+        state.setdefault("bookmarks", {}).update(bookmarks)
+        output.write_state(state)
 
 
 def write_schema(stream):
     schema = stream.schema.to_dict()
-    singer.write_schema(stream.tap_stream_id, schema, stream.key_properties)
+    output.write_schema(stream.tap_stream_id, schema, stream.key_properties)
+
+
+def write_record(stream_name, record):
+    output.write_record(stream_name, record)
+
+
+def is_property_selected(mdata, prop_name):
+    # same rules the Transformer uses to drop fields from a record
+    inclusion = metadata.get(mdata, ("properties", prop_name), "inclusion")
+    if inclusion == "automatic":
+        return True
+    if inclusion == "unsupported":
+        return False
+    return metadata.get(mdata, ("properties", prop_name), "selected") is not False
+
+
+def get_selected_properties(entitycls, stream, mdata):
+    required = set(stream.key_properties or []) | {MODIFIED_DATE_FIELD}
+    return [
+        odata_prop["name"]
+        for odata_prop in entitycls.__odata_schema__["properties"]
+        if odata_prop["name"] in required
+        or is_property_selected(mdata, odata_prop["name"])
+    ]
+
+
+def needs_projection(entitycls, properties):
+    # only ask for a projection when it actually drops columns
+    return len(properties) < len(entitycls.__odata_schema__["properties"])
 
 
-def sync_stream(service, catalog, state, start_date, stream, mdata):
+def select_params(entitycls, properties):
+    if needs_projection(entitycls, properties):
+        return {"$select": ",".join(properties)}
+    return {}
+
+
+def get_query(service, entitycls, properties):
+    query = service.query(entitycls)
+    if needs_projection(entitycls, properties):
+        query = query.select(*[getattr(entitycls, name) for name in properties])
+    return query
+
+
+def get_datetime_properties(entitycls):
+    return {
+        odata_prop["name"]
+        for odata_prop in entitycls.__odata_schema__["properties"]
+        if odata_prop["type"] in DATETIME_TYPES
+    }
+
+
+def record_to_dict(record, properties, datetime_properties=()):
+    dict_record = {}
+    if isinstance(record, dict):
+        # a query with select() yields the raw JSON rows, not entities
+        for prop_name in properties:
+            value = record.get(prop_name)
+            if value is not None and prop_name in datetime_properties:
+                value = singer.utils.strftime(singer.utils.strptime_with_tz(value))
+            dict_record[prop_name] = value
+        return dict_record
+
+    for prop_name in properties:
+        value = getattr(record, prop_name)
+        if isinstance(value, datetime):
+            value = singer.utils.strftime(value)
+        dict_record[prop_name] = value
+    return dict_record
+
+
+def format_odata_datetime(value):
+    return value.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def get_entity_pages(
+    service, entitycls, properties, page_size, since=None, until=None
+):
+    query = get_query(service, entitycls, properties)
+    if since is not None:
+        modified_field = getattr(entitycls, MODIFIED_DATE_FIELD)
+        query = query.filter(modified_field >= since)
+        if until is not None:
+            query = query.filter(modified_field < until)
+        query = query.order_by(modified_field.asc())
+
+    datetime_properties = get_datetime_properties(entitycls)
+
+    # the odata query iterator hides page boundaries, with odata.maxpagesize
+    # set every full server page holds exactly page_size rows
+    page = []
+    for record in query:
+        page.append(record_to_dict(record, properties, datetime_properties))
+        if len(page) >= page_size:
+            yield page
+            page = []
+    if page:
+        yield page
+
+
+def get_raw_pages(service, entitycls, properties, since=None, until=None):
+    params = select_params(entitycls, properties)
+    if since is not None:
+        filters = [
+            "{} ge {}".format(MODIFIED_DATE_FIELD, format_odata_datetime(since))
+        ]
+        if until is not None:
+            filters.append(
+                "{} lt {}".format(MODIFIED_DATE_FIELD, format_odata_datetime(until))
+            )
+        params["$filter"] = " and ".join(filters)
+        params["$orderby"] = "{} asc".format(MODIFIED_DATE_FIELD)
+
+    return client.iter_pages(service, entitycls.__odata_url__(), params)
+
+
+def format_key_value(value):
+    # guids and numbers are bare literals in a $filter, strings are quoted
+    if isinstance(value, str) and not GUID_PATTERN.match(value):
+        return "'{}'".format(value.replace("'", "''"))
+    return value
+
+
+def get_keyset_pages(
+    service, entitycls, properties, key_property, page_size, last_key=None
+):
+    # every page is its own query bounded by the last key seen, so no page
+    # depends on server-side paging state and a run can resume from any key.
+    # page_size must not exceed what the server returns in one page, or the
+    # first page would look like the last one
+    params = select_params(entitycls, properties)
+    params.update({"$orderby": "{} asc".format(key_property), "$top": page_size})
+
+    while True:
+        if last_key is not None:
+            params["$filter"] = "{} gt {}".format(
+                key_property, format_key_value(last_key)
+            )
+        page = client.get_json(service, entitycls.__odata_url__(), params).get(
+            "value", []
+        )
+        if page:
+            yield page
+        if len(page) < page_size:
+            return
+        last_key = page[-1][key_property]
+
+
+def get_pages(service, entitycls, properties, config, since=None, until=None):
+    if config.get("raw_json"):
+        pages = get_raw_pages(service, entitycls, properties, since, until)
+    else:
+        pages = get_entity_pages(
+            service, entitycls, properties, client.get_page_size(config), since, until
+        )
+    return client.maybe_prefetch(pages, config)
+
+
+def get_record_transformer(stream, mdata, properties):
+    schema = stream.schema.to_dict()
+    # rows may carry annotations and the forced key/modifiedon columns, only
+    # the selected properties make it into the record
+    coercers = build_coercers(
+        schema, [name for name in properties if is_property_selected(mdata, name)]
+    )
+    transformer = Transformer()
+
+    def transform_record(row):
+        try:
+            return coerce_record(row, coercers)
+        except (TypeError, ValueError):
+            # let the singer Transformer deal with values the plan can't
+            # coerce, it also reports real schema mismatches
+            return transformer.transform(row, schema, mdata)
+
+    return transform_record
+
+
+def get_max_modified(rows, max_modified):
+    for row in rows:
+        if row.get(MODIFIED_DATE_FIELD):
+            if max_modified is None or row[MODIFIED_DATE_FIELD] > max_modified:
+                max_modified = row[MODIFIED_DATE_FIELD]
+    return max_modified
+
+
+def write_page(stream_name, page, transform_record, counter, fetch_seconds=0.0):
+    # transform and write a page in two passes so both stages can be timed
+    started = time.perf_counter()
+    records = [transform_record(row) for row in page]
+    transformed = time.perf_counter()
+    for record in records:
+        write_record(stream_name, record)
+    counter.increment(len(records))
+
+    instrumentation.record_page(
+        stream_name,
+        len(records),
+        fetch=fetch_seconds,
+        transform=transformed - started,
+        write=time.perf_counter() - transformed,
+    )
+
+
+def sync_stream(service, catalog, state, start_date, stream, mdata, config=None):
+    config = config or {}
     stream_name = stream.tap_stream_id
     last_datetime = get_bookmark(state, stream_name, start_date)
 
@@ -35,116 +267,492 @@ def sync_stream(service, catalog, state, start_date, stream, mdata):
 
     max_modified = last_datetime
 
-    ## TODO: add metrics?
     entitycls = service.entities[stream_name]
-    query = service.query(entitycls)
+    properties = get_selected_properties(entitycls, stream, mdata)
+
+    if not hasattr(entitycls, MODIFIED_DATE_FIELD) and len(
+        stream.key_properties or []
+    ) == 1:
+        sync_stream_keyset(service, state, stream, mdata, properties, config)
+        return
+
+    if not isinstance(last_datetime, str):
+        # left behind by change tracking, keyset or bulk lookup syncs of this
+        # stream, none of them say which modifiedon to resume from
+        LOGGER.info(
+            "{} - Ignoring the bookmark {}, syncing since start_date {}".format(
+                stream_name, last_datetime, start_date
+            )
+        )
+        last_datetime = max_modified = start_date
 
     if hasattr(entitycls, MODIFIED_DATE_FIELD):
         # add 1 second to the last_datetime to avoid duplicates
         last_datetime = singer.utils.strptime_with_tz(last_datetime)
         last_datetime = (last_datetime + timedelta(seconds=1)).isoformat()
+
+        windows = get_time_windows(
+            singer.utils.strptime_with_tz(last_datetime),
+            config.get("backfill_window_days"),
+        )
+        if len(windows) > 1:
+            sync_stream_windows(
+                service, state, stream, mdata, windows, max_modified, config
+            )
+            return
+
         LOGGER.info(
             "{} - Syncing data since {}".format(stream.tap_stream_id, last_datetime)
         )
-        query = query.filter(
-            getattr(entitycls, MODIFIED_DATE_FIELD)
-            >= singer.utils.strptime_with_tz(last_datetime)
-        ).order_by(getattr(entitycls, MODIFIED_DATE_FIELD).asc())
+        pages = get_pages(
+            service,
+            entitycls,
+            properties,
+            config,
+            since=singer.utils.strptime_with_tz(last_datetime),
+        )
     else:
         LOGGER.info("{} - Syncing using full replication".format(stream.tap_stream_id))
+        pages = get_pages(service, entitycls, properties, config)
 
-    schema = stream.schema.to_dict()
+    transform_record = get_record_transformer(stream, mdata, properties)
 
-    count = 0
     with metrics.http_request_timer(stream.tap_stream_id):
         with metrics.record_counter(stream.tap_stream_id) as counter:
-            for record in query:
-                dict_record = {}
-                for odata_prop in entitycls.__odata_schema__["properties"]:
-                    prop_name = odata_prop["name"]
-                    value = getattr(record, prop_name)
-                    if isinstance(value, datetime):
-                        value = singer.utils.strftime(value)
-                    dict_record[prop_name] = value
-
-                if MODIFIED_DATE_FIELD in dict_record:
-                    if dict_record[MODIFIED_DATE_FIELD] > max_modified:
-                        max_modified = dict_record[MODIFIED_DATE_FIELD]
-
-                with Transformer() as transformer:
-                    dict_record = transformer.transform(dict_record, schema, mdata)
-                singer.write_record(stream.tap_stream_id, dict_record)
-                counter.increment()
-
-                count += 1
-                if count % 5000 == 0:
-                    write_bookmark(state, stream_name, max_modified)
+            for page, fetch_seconds in instrumentation.timed(pages):
+                max_modified = get_max_modified(page, max_modified)
+                write_page(stream_name, page, transform_record, counter, fetch_seconds)
 
-    write_bookmark(state, stream_name, max_modified)
+                # checkpoint on page boundaries so a restart repeats at most
+                # one page
+                write_bookmark(state, stream_name, max_modified)
 
+    write_bookmark(state, stream_name, max_modified)
 
-def update_current_stream(state, stream_name=None):
-    set_currently_syncing(state, stream_name)
-    singer.write_state(state)
 
+def sync_stream_keyset(service, state, stream, mdata, properties, config):
+    stream_name = stream.tap_stream_id
+    key_property = stream.key_properties[0]
+    bookmark = get_bookmark(state, stream_name, None)
+    last_key = bookmark.get("last_key") if isinstance(bookmark, dict) else None
 
-def sync(service, catalog, state, start_date):
-    if not catalog:
-        catalog = discover(service)
-        selected_streams = catalog.streams
+    if last_key is None:
+        LOGGER.info("{} - Syncing using full replication".format(stream_name))
     else:
-        selected_streams = catalog.get_selected_streams(state)
-        
-    for stream in selected_streams:
-        if stream.tap_stream_id == "view_leads":
-            stream.views = get_views_by_metadata(stream.metadata)
-            for stream_catalog in catalog.streams:
-                if stream_catalog.tap_stream_id == "leads":
-                    stream.metadata = stream_catalog.metadata
-                    stream.key_properties = stream_catalog.key_properties
-            mdata = metadata.to_map(stream.metadata)
-           
-            update_current_stream(state, stream.tap_stream_id)
-            sync_stream_views('savedQuery','leads',service, stream)
-        elif stream.tap_stream_id == "view_personal_leads":
-            stream.views = get_views_by_metadata(stream.metadata)
-            for stream_catalog in catalog.streams:
-                if stream_catalog.tap_stream_id == "leads":
-                    stream.metadata = stream_catalog.metadata
-                    stream.key_properties = stream_catalog.key_properties
-            mdata = metadata.to_map(stream.metadata)
+        LOGGER.info(
+            "{} - Resuming full replication after {} {}".format(
+                stream_name, key_property, last_key
+            )
+        )
 
-            update_current_stream(state, stream.tap_stream_id)
-            sync_stream_views('userQuery', 'leads', service, stream)
+    entitycls = service.entities[stream_name]
+    pages = get_keyset_pages(
+        service,
+        entitycls,
+        properties,
+        key_property,
+        client.get_page_size(config),
+        last_key,
+    )
+    pages = client.maybe_prefetch(pages, config)
+
+    transform_record = get_record_transformer(stream, mdata, properties)
+
+    with metrics.http_request_timer(stream_name):
+        with metrics.record_counter(stream_name) as counter:
+            for page, fetch_seconds in instrumentation.timed(pages):
+                write_page(stream_name, page, transform_record, counter, fetch_seconds)
+                write_bookmark(
+                    state, stream_name, {"last_key": page[-1][key_property]}
+                )
+
+    # a finished table starts from the first key again on the next run
+    write_bookmark(state, stream_name, {"last_key": None})
+
+
+def is_bulk_lookup_stream(stream):
+    return (
+        is_lookup_table(stream.tap_stream_id)
+        and stream.replication_method != CHANGE_TRACKING
+    )
+
+
+def get_lookup_url(entitycls, properties, key_properties):
+    params = select_params(entitycls, properties)
+    if key_properties:
+        # a stable row order keeps the content hash stable
+        params["$orderby"] = ",".join(
+            "{} asc".format(key_property) for key_property in key_properties
+        )
+    url = entitycls.__odata_url__()
+    if params:
+        url += "?" + urlencode(params, safe="$,'", quote_via=quote)
+    return url
 
-        elif stream.tap_stream_id == "view_contacts":
-            stream.views = get_views_by_metadata(stream.metadata)
-            for stream_catalog in catalog.streams:
-                if stream_catalog.tap_stream_id == "contacts":
-                    stream.metadata = stream_catalog.metadata
-                    stream.key_properties = stream_catalog.key_properties
-            mdata = metadata.to_map(stream.metadata)
 
-            update_current_stream(state, stream.tap_stream_id)
-            sync_stream_views('savedQuery','contacts', service, stream)
+def get_content_hash(records):
+    digest = hashlib.sha256()
+    for record in records:
+        digest.update(json.dumps(record, sort_keys=True, default=str).encode("utf-8"))
+        digest.update(b"\n")
+    return digest.hexdigest()
 
-        elif stream.tap_stream_id == "view_personal_contacts":
-            stream.views = get_views_by_metadata(stream.metadata)
-            for stream_catalog in catalog.streams:
-                if stream_catalog.tap_stream_id == "contacts":
-                    stream.metadata = stream_catalog.metadata
-                    stream.key_properties = stream_catalog.key_properties
+
+def sync_lookup_tables(service, state, streams, config):
+    # lookup tables are small and numerous, so they are read with one $batch
+    # per chunk of tables and only emitted when their content changed
+    batch_size = int(config.get("lookup_batch_size", DEFAULT_LOOKUP_BATCH_SIZE))
+    LOGGER.info("Syncing {} lookup tables in bulk".format(len(streams)))
+
+    for start in range(0, len(streams), batch_size):
+        plans = []
+        for stream in streams[start : start + batch_size]:
             mdata = metadata.to_map(stream.metadata)
+            entitycls = service.entities[stream.tap_stream_id]
+            properties = get_selected_properties(entitycls, stream, mdata)
+            plans.append(
+                (
+                    stream,
+                    get_record_transformer(stream, mdata, properties),
+                    get_lookup_url(entitycls, properties, stream.key_properties),
+                )
+            )
+
+        results = client.batch_get_values(service, [url for _, _, url in plans])
+
+        bookmarks = {}
+        for (stream, transform_record, _), rows in zip(plans, results):
+            stream_name = stream.tap_stream_id
+            records = [transform_record(row) for row in rows]
+            content_hash = get_content_hash(records)
+
+            bookmark = get_bookmark(state, stream_name, None)
+            if isinstance(bookmark, dict) and bookmark.get("content_hash") == content_hash:
+                LOGGER.info("{} - Unchanged since the last sync".format(stream_name))
+                continue
+
+            write_schema(stream)
+            with metrics.record_counter(stream_name) as counter:
+                write_page(stream_name, records, lambda record: record, counter)
+            bookmarks[stream_name] = {"content_hash": content_hash}
 
-            update_current_stream(state, stream.tap_stream_id)
-            sync_stream_views('userQuery','contacts', service, stream)
+        if bookmarks:
+            write_bookmarks(state, bookmarks)
 
+
+def is_expired_delta_link_error(exc):
+    # Dataverse answers a delta link older than its retention window with
+    # ExpiredVersionStamp (0x80044352), the client has to start over
+    message = str(exc).lower()
+    return "0x80044352" in message or ("version" in message and "expired" in message)
+
+
+def is_deleted_row(row):
+    return "$deletedEntity" in row.get("@odata.context", "")
+
+
+def sync_stream_changes(service, state, stream, mdata, config):
+    stream_name = stream.tap_stream_id
+    bookmark = get_bookmark(state, stream_name, None)
+    delta_link = bookmark.get("delta_link") if isinstance(bookmark, dict) else None
+    if bookmark is not None and not isinstance(bookmark, dict):
+        LOGGER.info(
+            "{} - Replacing the modifiedon bookmark {} with change tracking".format(
+                stream_name, bookmark
+            )
+        )
+
+    write_schema(stream)
+
+    entitycls = service.entities[stream_name]
+    properties = get_selected_properties(entitycls, stream, mdata)
+    headers = {
+        "Prefer": client.get_prefer_header(client.get_page_size(config))
+        + ",odata.track-changes"
+    }
+
+    responses = None
+    if delta_link:
+        LOGGER.info("{} - Syncing changes since the last delta link".format(stream_name))
+        responses = client.iter_responses(service, delta_link, headers=headers)
+        try:
+            responses = itertools.chain([next(responses)], responses)
+        except Exception as exc:
+            if not is_expired_delta_link_error(exc):
+                raise
+            LOGGER.warning(
+                "{} - Delta link expired past the change tracking retention".format(
+                    stream_name
+                )
+            )
+            delta_link = None
+            responses = None
+
+    if responses is None:
+        # change tracking has no start date, the first sync reads everything
+        LOGGER.info(
+            "{} - Starting change tracking with a full sync, start_date is ignored".format(
+                stream_name
+            )
+        )
+        responses = client.iter_responses(
+            service,
+            entitycls.__odata_url__(),
+            select_params(entitycls, properties),
+            headers,
+        )
+
+    responses = client.maybe_prefetch(responses, config)
+
+    transform_record = get_record_transformer(stream, mdata, properties)
+    key_property = stream.key_properties[0]
+    deleted_at = singer.utils.strftime(singer.utils.now())
+
+    def transform_change(row):
+        if is_deleted_row(row):
+            return {key_property: row["id"], DELETED_AT_FIELD: deleted_at}
+        record = transform_record(row)
+        record[DELETED_AT_FIELD] = None
+        return record
+
+    with metrics.http_request_timer(stream_name):
+        with metrics.record_counter(stream_name) as counter:
+            for data, fetch_seconds in instrumentation.timed(responses):
+                write_page(
+                    stream_name,
+                    data.get("value", []),
+                    transform_change,
+                    counter,
+                    fetch_seconds,
+                )
+
+                # the delta link only comes with the last page, a run that
+                # stops before it starts again from the previous link
+                if data.get("@odata.deltaLink"):
+                    delta_link = data["@odata.deltaLink"]
+
+    write_bookmark(state, stream_name, {"delta_link": delta_link})
+
+
+def get_time_windows(since, window_days):
+    # the last window is open-ended so rows modified during the sync are kept
+    if not window_days:
+        return [(since, None)]
+
+    window = timedelta(days=float(window_days))
+    now = singer.utils.now()
+    windows = []
+    window_start = since
+    while window_start + window < now:
+        windows.append((window_start, window_start + window))
+        window_start += window
+    windows.append((window_start, None))
+    return windows
+
+
+def sync_window(service, stream, mdata, window_start, window_end, config):
+    with instrumentation.stream_context(stream.tap_stream_id):
+        return sync_window_pages(
+            service, stream, mdata, window_start, window_end, config
+        )
+
+
+def sync_window_pages(service, stream, mdata, window_start, window_end, config):
+    entitycls = service.entities[stream.tap_stream_id]
+    properties = get_selected_properties(entitycls, stream, mdata)
+    pages = get_pages(
+        service, entitycls, properties, config, since=window_start, until=window_end
+    )
+    transform_record = get_record_transformer(stream, mdata, properties)
+
+    max_modified = None
+    with metrics.record_counter(stream.tap_stream_id) as counter:
+        for page, fetch_seconds in instrumentation.timed(pages):
+            max_modified = get_max_modified(page, max_modified)
+            write_page(
+                stream.tap_stream_id, page, transform_record, counter, fetch_seconds
+            )
+
+    return max_modified
+
+
+def sync_stream_windows(service, state, stream, mdata, windows, bookmark, config):
+    stream_name = stream.tap_stream_id
+    max_workers = int(config.get("max_parallel_windows", 4))
+    LOGGER.info(
+        "{} - Backfilling from {} in {} windows with up to {} workers".format(
+            stream_name, windows[0][0].isoformat(), len(windows), max_workers
+        )
+    )
+
+    with metrics.http_request_timer(stream_name):
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(
+                    sync_window,
+                    service,
+                    stream,
+                    mdata,
+                    window_start,
+                    window_end,
+                    config,
+                )
+                for window_start, window_end in windows
+            ]
+            try:
+                # waiting in window order means the bookmark only moves past
+                # a window once it and every window before it is complete
+                for (window_start, window_end), future in zip(windows, futures):
+                    max_modified = future.result()
+                    if window_end is not None:
+                        bookmark = singer.utils.strftime(
+                            window_end - timedelta(seconds=1)
+                        )
+                    elif max_modified is not None and singer.utils.strptime_with_tz(
+                        max_modified
+                    ) > singer.utils.strptime_with_tz(bookmark):
+                        bookmark = max_modified
+                    write_bookmark(state, stream_name, bookmark)
+            except Exception:
+                for pending in futures:
+                    pending.cancel()
+                raise
+
+
+def update_current_stream(state, stream_name=None):
+    with WRITE_LOCK:
+        set_currently_syncing(state, stream_name)
+        output.write_state(state)
+
+
+def sync(service, catalog, state, start_date, config=None):
+    config = config or {}
+    if not catalog:
+        catalog = discover(service, config.get("get_lookup_tables", False), config)
+        selected_streams = catalog.streams
+    else:
+        selected_streams = list(catalog.get_selected_streams(state))
+
+    lookup_streams = []
+    if config.get("bulk_lookup_tables"):
+        lookup_streams = [
+            stream for stream in selected_streams if is_bulk_lookup_stream(stream)
+        ]
+        selected_streams = [
+            stream for stream in selected_streams if not is_bulk_lookup_stream(stream)
+        ]
+
+    output.configure(config)
+    max_parallel_streams = int(config.get("max_parallel_streams", 1))
+    try:
+        if lookup_streams:
+            sync_lookup_tables(service, state, lookup_streams, config)
+
+        if max_parallel_streams > 1 and len(selected_streams) > 1:
+            sync_parallel(
+                service,
+                catalog,
+                state,
+                start_date,
+                selected_streams,
+                max_parallel_streams,
+                config,
+            )
         else:
-            mdata = metadata.to_map(stream.metadata)
-            update_current_stream(state, stream.tap_stream_id)
-            sync_stream(service, catalog, state, start_date, stream, mdata)
+            for stream in selected_streams:
+                update_current_stream(state, stream.tap_stream_id)
+                sync_selected_stream(
+                    service, catalog, state, start_date, stream, config
+                )
+
+        update_current_stream(state)
+    finally:
+        output.flush()
+
+
+def sync_parallel(
+    service, catalog, state, start_date, selected_streams, max_workers, config
+):
+    # currently_syncing is meaningless with several streams in flight, so it is
+    # left unset; each stream still checkpoints its own bookmark
+    LOGGER.info(
+        "Syncing %s streams with up to %s in parallel",
+        len(selected_streams),
+        max_workers,
+    )
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(
+                sync_selected_stream,
+                service,
+                catalog,
+                state,
+                start_date,
+                stream,
+                config,
+            ): stream.tap_stream_id
+            for stream in selected_streams
+        }
+        try:
+            for future in as_completed(futures):
+                future.result()
+                LOGGER.info("{} - Finished syncing".format(futures[future]))
+        except Exception:
+            LOGGER.error("{} - Sync failed".format(futures[future]))
+            for pending in futures:
+                pending.cancel()
+            raise
+
+
+def sync_selected_stream(service, catalog, state, start_date, stream, config):
+    with instrumentation.stream_context(stream.tap_stream_id):
+        sync_catalog_stream(service, catalog, state, start_date, stream, config)
+    instrumentation.finish_stream(stream.tap_stream_id)
+
+
+def sync_catalog_stream(service, catalog, state, start_date, stream, config):
+    if stream.tap_stream_id == "view_leads":
+        stream.views = get_views_by_metadata(stream.metadata)
+        for stream_catalog in catalog.streams:
+            if stream_catalog.tap_stream_id == "leads":
+                stream.metadata = stream_catalog.metadata
+                stream.key_properties = stream_catalog.key_properties
+
+        sync_stream_views('savedQuery','leads',service, stream, state, start_date, config)
+    elif stream.tap_stream_id == "view_personal_leads":
+        stream.views = get_views_by_metadata(stream.metadata)
+        for stream_catalog in catalog.streams:
+            if stream_catalog.tap_stream_id == "leads":
+                stream.metadata = stream_catalog.metadata
+                stream.key_properties = stream_catalog.key_properties
+
+        sync_stream_views('userQuery', 'leads', service, stream, state, start_date, config)
+
+    elif stream.tap_stream_id == "view_contacts":
+        stream.views = get_views_by_metadata(stream.metadata)
+        for stream_catalog in catalog.streams:
+            if stream_catalog.tap_stream_id == "contacts":
+                stream.metadata = stream_catalog.metadata
+                stream.key_properties = stream_catalog.key_properties
+
+        sync_stream_views('savedQuery','contacts', service, stream, state, start_date, config)
+
+    elif stream.tap_stream_id == "view_personal_contacts":
+        stream.views = get_views_by_metadata(stream.metadata)
+        for stream_catalog in catalog.streams:
+            if stream_catalog.tap_stream_id == "contacts":
+                stream.metadata = stream_catalog.metadata
+                stream.key_properties = stream_catalog.key_properties
+
+        sync_stream_views('userQuery','contacts', service, stream, state, start_date, config)
+
+    elif stream.replication_method == CHANGE_TRACKING:
+        mdata = metadata.to_map(stream.metadata)
+        sync_stream_changes(service, state, stream, mdata, config)
 
-    update_current_stream(state)
+    else:
+        mdata = metadata.to_map(stream.metadata)
+        sync_stream(service, catalog, state, start_date, stream, mdata, config)
 
 
 def get_views_by_metadata(metadata):
@@ -158,32 +766,128 @@ def get_views_by_metadata(metadata):
                 
     return selected_views
 
-def get_items_by_view(query_param,entity,service,views):
+VIEW_ENTITIES = {"savedQuery": "savedqueries", "userQuery": "userqueries"}
+
+
+def add_modified_condition(fetchxml, since):
+    fetch = ET.fromstring(fetchxml)
+    entity = fetch.find("entity")
+
+    # wrap the view's own filters so the new condition is and-ed with them
+    view_filter = ET.Element("filter", {"type": "and"})
+    for existing in entity.findall("filter"):
+        entity.remove(existing)
+        view_filter.append(existing)
+    ET.SubElement(
+        view_filter,
+        "condition",
+        {
+            "attribute": MODIFIED_DATE_FIELD,
+            "operator": "ge",
+            "value": format_odata_datetime(since),
+        },
+    )
+    entity.append(view_filter)
+
+    # the bookmark is read from the rows, so the column has to come back
+    if entity.find("all-attributes") is None and not any(
+        attribute.get("name") == MODIFIED_DATE_FIELD
+        for attribute in entity.findall("attribute")
+    ):
+        ET.SubElement(entity, "attribute", {"name": MODIFIED_DATE_FIELD})
+
+    return fetch
+
+
+def get_incremental_view_pages(query_param, entity, service, view_id, since, config):
+    # a generator, so a missing view only fails once the first page is read
+    view_entity = VIEW_ENTITIES[query_param]
+    view = client.get_json(
+        service,
+        "{}{}({})".format(service.url, view_entity, view_id),
+        {"$select": "fetchxml"},
+    )
+    fetch = add_modified_condition(view["fetchxml"], since)
+
     entitycls = service.entities[entity]
-    query = service.query(entitycls)
-    dict_views = {}
-    for view_name,view_id in views.items():
+    yield from client.iter_fetchxml_pages(
+        service, entitycls.__odata_url__(), fetch, client.get_page_size(config)
+    )
+
+
+def get_view_pages(query_param, entity, service, view_id, config, since=None):
+    if since is not None:
+        pages = get_incremental_view_pages(
+            query_param, entity, service, view_id, since, config
+        )
+    else:
+        entitycls = service.entities[entity]
+        pages = client.iter_pages(
+            service, entitycls.__odata_url__(), {query_param: "{}".format(view_id)}
+        )
+    return iter(client.maybe_prefetch(pages, config))
+
+
+def sync_stream_views(
+    query_param, entity, service, stream, state=None, start_date=None, config=None
+):
+    config = config or {}
+    state = state if state is not None else {}
+    incremental = config.get("incremental_views", False) and hasattr(
+        service.entities[entity], MODIFIED_DATE_FIELD
+    )
+
+    for view_name, view_id in stream.views.items():
+        stream_name = f"{view_name} ({entity})"
+        bookmark = None
+        since = None
+        if incremental:
+            bookmark = get_bookmark(state, stream_name, start_date)
+            # add 1 second to the bookmark to avoid duplicates
+            since = singer.utils.strptime_with_tz(bookmark) + timedelta(seconds=1)
+            LOGGER.info("{} - Syncing view data since {}".format(stream_name, since))
+
+        pages = get_view_pages(query_param, entity, service, view_id, config, since)
         try:
-            view = query.raw({query_param: "{}".format(view_id)})
-            dict_views[view_name]=view
-        except:
+            first_page = next(pages, [])
+        except Exception:
             LOGGER.info("View not found: %s", view_id)
-        
-    return dict_views
+            continue
+
+        max_modified = sync_view(
+            stream_name,
+            itertools.chain([first_page], pages),
+            stream.key_properties,
+            bookmark,
+        )
+        if incremental:
+            write_bookmark(state, stream_name, max_modified)
+
+
+def sync_view(stream_name, pages, key_properties, max_modified=None):
+    # the schema is inferred page by page and re-sent whenever a page widens
+    # it, so only one page of the view is ever held in memory
+    schema = {"properties": {}, "type": "object", "additionalProperties": True}
+    schema_written = False
 
+    def fill_record(record):
+        fields_record = {k: None for k in schema["properties"]}
+        fields_record.update(record)
+        return fields_record
 
-def sync_stream_views(query_param,entity,service, stream):
-   
-    dict_views = get_items_by_view(query_param, entity, service, stream.views)
+    with metrics.record_counter(stream_name) as counter:
+        for page, fetch_seconds in instrumentation.timed(pages):
+            if update_schema_properties(schema, page) or not schema_written:
+                output.write_schema(stream_name, schema, key_properties)
+                schema_written = True
 
-    for stream_name, records in dict_views.items():
-        custom_schema, fields_record = create_schema_properties(records)
-        singer.write_schema(f"{stream_name} ({entity})", custom_schema, stream.key_properties)
-        if len(records) > 0:
-            for record in records:
-                fields_record.update(record)
-                singer.write_record(f"{stream_name} ({entity})", fields_record)
-                fields_record = {k: None for k in fields_record}
+            max_modified = get_max_modified(page, max_modified)
+            write_page(stream_name, page, fill_record, counter, fetch_seconds)
+
+    if not schema_written:
+        output.write_schema(stream_name, schema, key_properties)
+
+    return max_modified
 
 
 def infer_type(value):
@@ -210,19 +914,22 @@ def infer_type(value):
         return ["object", {"properties": properties}]
 
 
-def create_schema_properties(records):
-    schema = {"properties": {}, "type": "object", "additionalProperties": True}
-
-    fields_record = {}
-
-    if len(records) > 0:
-        for record in records:
-            record.pop("@odata.etag", None)
-            for field, value in record.items():
-                types = infer_type(value)
-                types.append("null")
-                fields_record[field] = None
-                if field not in schema["properties"]:
-                    schema["properties"][field] = {"type": types}
-
-    return schema, fields_record
+def update_schema_properties(schema, records):
+    changed = False
+
+    for record in records:
+        record.pop("@odata.etag", None)
+        for field, value in record.items():
+            types = infer_type(value) if value is not None else []
+            types.append("null")
+            prop = schema["properties"].get(field)
+            if prop is None:
+                schema["properties"][field] = {"type": types}
+                changed = True
+            elif types[0] not in prop["type"] and all(
+                isinstance(typ, str) for typ in types
+            ):
+                prop["type"] = [types[0]] + prop["type"]
+                changed = True
+
+    return changed
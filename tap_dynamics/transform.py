@@ -0,0 +1,67 @@
+import singer
+
+
+def coerce_datetime(value):
+    # UTC timestamps from the Web API or singer.utils.strftime are kept as is
+    if isinstance(value, str) and value.endswith("Z"):
+        return value
+    return singer.utils.strftime(singer.utils.strptime_to_utc(value))
+
+
+def coerce_integer(value):
+    return value if isinstance(value, int) else int(value)
+
+
+def coerce_number(value):
+    return value if isinstance(value, (int, float)) else float(value)
+
+
+def coerce_boolean(value):
+    if isinstance(value, str):
+        return value.lower() != "false"
+    return bool(value)
+
+
+def coerce_string(value):
+    return value if isinstance(value, str) else str(value)
+
+
+TYPE_COERCERS = {
+    "integer": coerce_integer,
+    "number": coerce_number,
+    "boolean": coerce_boolean,
+    "string": coerce_string,
+}
+
+
+def get_coercer(prop_schema):
+    if prop_schema.get("format") == "date-time":
+        return coerce_datetime
+
+    types = prop_schema.get("type", [])
+    if isinstance(types, str):
+        types = [types]
+    for json_type in types:
+        if json_type in TYPE_COERCERS:
+            return TYPE_COERCERS[json_type]
+    return None
+
+
+# a stream's coercion plan: one (property, coercer) pair per selected property,
+# built once from the discovered schema instead of walking it for every record
+def build_coercers(schema, properties):
+    schema_properties = schema.get("properties", {})
+    return [
+        (prop_name, get_coercer(schema_properties.get(prop_name, {})))
+        for prop_name in properties
+    ]
+
+
+def coerce_record(row, coercers):
+    record = {}
+    for prop_name, coercer in coercers:
+        value = row.get(prop_name)
+        if value is not None and coercer is not None:
+            value = coercer(value)
+        record[prop_name] = value
+    return record
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import json
+import sys
+import time
+from collections import OrderedDict
+from contextlib import redirect_stdout
+
+import singer
+from singer.catalog import Catalog
+
+from tap_dynamics import (
+    REQUIRED_CONFIG_KEYS,
+    build_service,
+    do_discover,
+    get_url,
+    instrumentation,
+)
+from tap_dynamics.auth import TOKEN_FIELDS
+from tap_dynamics.client import get_connection
+from tap_dynamics.sync import sync
+
+LOGGER = singer.get_logger()
+
+DEFAULT_MAX_ORGS = 100
+DEFAULT_REFLECTION_TTL = 60 * 60
+
+
+def get_config_hash(config):
+    # the tokens rotate on every refresh and are not part of an org's settings
+    settings = {key: value for key, value in config.items() if key not in TOKEN_FIELDS}
+    return hashlib.sha256(
+        json.dumps(settings, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+class Worker:
+    # runs jobs one at a time, keeping the reflected service, the session and
+    # the token of every org warm between its jobs with the same settings
+    def __init__(self, max_orgs=DEFAULT_MAX_ORGS, reflection_ttl=DEFAULT_REFLECTION_TTL):
+        self.max_orgs = max_orgs
+        self.reflection_ttl = reflection_ttl
+        self.services = OrderedDict()
+
+    def get_service(self, parsed_args):
+        # rotated refresh tokens are written back to the job's config file, so
+        # the config path is part of the key, and the session is built from the
+        # job's settings, so a job with other settings gets its own service
+        key = (
+            get_url(parsed_args.config),
+            parsed_args.config_path,
+            get_config_hash(parsed_args.config),
+        )
+        cached = self.services.pop(key, None)
+        if cached is not None:
+            service, reflected_at = cached
+            if time.monotonic() - reflected_at < self.reflection_ttl:
+                self.services[key] = cached
+                return service
+            self.close_service(service)
+
+        # the settings of this org changed, its old service is never used again
+        for stale_key in [
+            cached_key for cached_key in self.services if cached_key[:2] == key[:2]
+        ]:
+            stale_service, _ = self.services.pop(stale_key)
+            self.close_service(stale_service)
+
+        LOGGER.info("Reflecting %s", key[0])
+        # reflect for every stream discovery can return, so later jobs with a
+        # different catalog can share the service
+        service = build_service(parsed_args)
+        self.services[key] = (service, time.monotonic())
+        while len(self.services) > self.max_orgs:
+            _, (evicted, _) = self.services.popitem(last=False)
+            self.close_service(evicted)
+        return service
+
+    def close_service(self, service):
+        connection = get_connection(service)
+        connection.auth.close()
+        connection.session.close()
+
+    def run_job(self, job):
+        config = singer.utils.load_json(job["config"])
+        singer.utils.check_config(config, REQUIRED_CONFIG_KEYS)
+        parsed_args = argparse.Namespace(config=config, config_path=job["config"])
+        catalog = Catalog.load(job["catalog"]) if job.get("catalog") else None
+        state = singer.utils.load_json(job["state"]) if job.get("state") else {}
+
+        service = self.get_service(parsed_args)
+        if config.get("profile"):
+            instrumentation.enable()
+        try:
+            with open(job["output"], "w") as sink, redirect_stdout(sink):
+                catalog = catalog or do_discover(
+                    service, config.get("get_lookup_tables", False), config
+                )
+                if job.get("discover"):
+                    json.dump(catalog.to_dict(), sys.stdout, indent=2)
+                else:
+                    sync(service, catalog, state, config["start_date"], config)
+            instrumentation.report()
+        finally:
+            instrumentation.disable()
+            # no background token refreshes for orgs without a running job,
+            # the next job refreshes the token when it needs one
+            get_connection(service).auth.close()
+
+    def run(self, jobs, results):
+        for line in jobs:
+            if not line.strip():
+                continue
+            job = json.loads(line)
+            job_id = job.get("id", job.get("output"))
+            started = time.monotonic()
+            result = {"id": job_id, "status": "succeeded"}
+            try:
+                self.run_job(job)
+            except Exception as exc:
+                LOGGER.exception("Job %s failed", job_id)
+                result = {"id": job_id, "status": "failed", "error": str(exc)}
+            result["seconds"] = round(time.monotonic() - started, 3)
+            results.write(json.dumps(result) + "\n")
+            results.flush()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Run tap-dynamics jobs for many orgs from one process"
+    )
+    parser.add_argument(
+        "--jobs",
+        help="file with one JSON job per line (default: read jobs from stdin)",
+    )
+    parser.add_argument(
+        "--max-orgs",
+        type=int,
+        default=DEFAULT_MAX_ORGS,
+        help="reflected orgs kept in memory",
+    )
+    parser.add_argument(
+        "--reflection-ttl",
+        type=float,
+        default=DEFAULT_REFLECTION_TTL,
+        help="seconds before an org's $metadata is reflected again",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    worker = Worker(args.max_orgs, args.reflection_ttl)
+    if args.jobs:
+        with open(args.jobs) as jobs:
+            worker.run(jobs, sys.stdout)
+    else:
+        worker.run(sys.stdin, sys.stdout)
+
+
+if __name__ == "__main__":
+    main()
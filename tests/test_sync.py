@@ -0,0 +1,297 @@
+import importlib
+import threading
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from singer.catalog import CatalogEntry, Schema
+
+from tap_dynamics import output
+
+# tap_dynamics.sync is shadowed by the sync() function on the package
+sync_module = importlib.import_module("tap_dynamics.sync")
+
+ODATA_PROPERTIES = [
+    {"name": "accountid", "type": "Edm.Guid", "is_primary_key": True},
+    {"name": "name", "type": "Edm.String", "is_primary_key": False},
+    {"name": "new_column1", "type": "Edm.String", "is_primary_key": False},
+    {"name": "modifiedon", "type": "Edm.DateTimeOffset", "is_primary_key": False},
+]
+
+ROWS = [
+    {
+        "@odata.etag": 'W/"1"',
+        "accountid": "00000001-0000-0000-0000-000000000000",
+        "name": "first",
+        "new_column1": "dropped",
+        "modifiedon": "2020-01-01T00:00:00Z",
+    },
+    {
+        "@odata.etag": 'W/"2"',
+        "accountid": "00000002-0000-0000-0000-000000000000",
+        "name": "second",
+        "new_column1": "dropped",
+        "modifiedon": "2020-01-02T00:00:00Z",
+    },
+]
+
+
+class FakeProperty:
+    def __init__(self, name):
+        self.name = name
+
+    def __ge__(self, other):
+        return (self.name, "ge", other)
+
+    def __lt__(self, other):
+        return (self.name, "lt", other)
+
+    def asc(self):
+        return self
+
+
+class FakeQuery:
+    def __init__(self, rows):
+        self.rows = rows
+        self.selected = None
+
+    def select(self, *props):
+        self.selected = [prop.name for prop in props]
+        return self
+
+    def filter(self, _):
+        return self
+
+    def order_by(self, _):
+        return self
+
+    def __iter__(self):
+        # like python-odata, a projected query yields raw JSON rows
+        if self.selected is None:
+            raise AssertionError("expected a projected query")
+        return iter(
+            [{name: row[name] for name in self.selected} for row in self.rows]
+        )
+
+
+class Account:
+    __odata_schema__ = {"properties": ODATA_PROPERTIES}
+    accountid = FakeProperty("accountid")
+    name = FakeProperty("name")
+    new_column1 = FakeProperty("new_column1")
+    modifiedon = FakeProperty("modifiedon")
+
+    @staticmethod
+    def __odata_url__():
+        return "accounts"
+
+
+class FakeService:
+    entities = {"accounts": Account}
+
+    def query(self, entitycls):
+        return FakeQuery(ROWS)
+
+
+def get_stream():
+    schema = {
+        "type": "object",
+        "properties": {
+            "accountid": {"type": ["null", "string"]},
+            "name": {"type": ["null", "string"]},
+            "new_column1": {"type": ["null", "string"]},
+            "modifiedon": {"type": ["null", "string"], "format": "date-time"},
+        },
+    }
+    metadata = [{"breadcrumb": [], "metadata": {"selected": True}}]
+    for name in schema["properties"]:
+        entry = {"inclusion": "available"}
+        if name == "new_column1":
+            entry["selected"] = False
+        metadata.append({"breadcrumb": ["properties", name], "metadata": entry})
+    return CatalogEntry(
+        stream="accounts",
+        tap_stream_id="accounts",
+        key_properties=["accountid"],
+        schema=Schema.from_dict(schema),
+        metadata=metadata,
+        replication_method="INCREMENTAL",
+    )
+
+
+def test_sync_stream_with_a_deselected_field(monkeypatch):
+    records = []
+    states = []
+    monkeypatch.setattr(output, "WRITER", None)
+    monkeypatch.setattr(
+        output, "write_record", lambda stream, record: records.append(record)
+    )
+    monkeypatch.setattr(output, "write_schema", lambda *args: None)
+    monkeypatch.setattr(output, "write_state", lambda state: states.append(state))
+
+    stream = get_stream()
+    mdata = sync_module.metadata.to_map(stream.metadata)
+    state = {}
+    sync_module.sync_stream(
+        FakeService(), None, state, "2019-01-01T00:00:00Z", stream, mdata, {}
+    )
+
+    assert records == [
+        {
+            "accountid": "00000001-0000-0000-0000-000000000000",
+            "name": "first",
+            "modifiedon": "2020-01-01T00:00:00.000000Z",
+        },
+        {
+            "accountid": "00000002-0000-0000-0000-000000000000",
+            "name": "second",
+            "modifiedon": "2020-01-02T00:00:00.000000Z",
+        },
+    ]
+    assert state["bookmarks"]["accounts"] == "2020-01-02T00:00:00.000000Z"
+
+
+def test_sync_stream_ignores_a_change_tracking_bookmark(monkeypatch):
+    records = []
+    monkeypatch.setattr(output, "WRITER", None)
+    monkeypatch.setattr(
+        output, "write_record", lambda stream, record: records.append(record)
+    )
+    monkeypatch.setattr(output, "write_schema", lambda *args: None)
+    monkeypatch.setattr(output, "write_state", lambda state: None)
+
+    stream = get_stream()
+    mdata = sync_module.metadata.to_map(stream.metadata)
+    state = {"bookmarks": {"accounts": {"delta_link": "change-tracking-was-disabled"}}}
+    sync_module.sync_stream(
+        FakeService(), None, state, "2019-01-01T00:00:00Z", stream, mdata, {}
+    )
+
+    assert len(records) == 2
+    assert state["bookmarks"]["accounts"] == "2020-01-02T00:00:00.000000Z"
+
+
+def test_expired_delta_link_falls_back_to_a_full_sync(monkeypatch):
+    records = []
+    monkeypatch.setattr(output, "WRITER", None)
+    monkeypatch.setattr(
+        output, "write_record", lambda stream, record: records.append(record)
+    )
+    monkeypatch.setattr(output, "write_schema", lambda *args: None)
+    monkeypatch.setattr(output, "write_state", lambda state: None)
+
+    requested = []
+
+    def iter_responses(service, url, params=None, headers=None):
+        requested.append(url)
+        if url == "expired-delta-link":
+            raise Exception(
+                '{"error":{"code":"0x80044352","message":"Version stamp '
+                'associated with the client has expired."}}'
+            )
+        yield {"value": ROWS, "@odata.deltaLink": "new-delta-link"}
+
+    monkeypatch.setattr(sync_module.client, "iter_responses", iter_responses)
+
+    stream = get_stream()
+    mdata = sync_module.metadata.to_map(stream.metadata)
+    state = {"bookmarks": {"accounts": {"delta_link": "expired-delta-link"}}}
+    sync_module.sync_stream_changes(FakeService(), state, stream, mdata, {})
+
+    assert requested == ["expired-delta-link", "accounts"]
+    assert len(records) == 2
+    assert state["bookmarks"]["accounts"] == {"delta_link": "new-delta-link"}
+
+
+def test_keyset_pages_are_capped_at_the_server_page_size(monkeypatch):
+    keys = ["{:08d}-0000-0000-0000-000000000000".format(i) for i in range(12000)]
+    requested = []
+
+    def get_json(service, url, params=None, headers=None):
+        requested.append(dict(params))
+        # the Web API caps every page at 5000 rows whatever $top asks for
+        start = 0
+        if "$filter" in params:
+            start = keys.index(params["$filter"].split(" gt ")[1]) + 1
+        end = start + min(params["$top"], sync_module.client.DEFAULT_PAGE_SIZE)
+        return {"value": [{"accountid": key} for key in keys[start:end]]}
+
+    monkeypatch.setattr(sync_module.client, "get_json", get_json)
+
+    pages = list(
+        sync_module.get_keyset_pages(
+            FakeService(),
+            Account,
+            ["accountid"],
+            "accountid",
+            sync_module.client.get_page_size({"page_size": 10000}),
+        )
+    )
+
+    assert [len(page) for page in pages] == [5000, 5000, 2000]
+    assert all(params["$top"] == 5000 for params in requested)
+
+
+
+WINDOW_START = datetime(2020, 1, 1, tzinfo=timezone.utc)
+WINDOWS = [
+    (WINDOW_START + timedelta(days=10 * i), WINDOW_START + timedelta(days=10 * (i + 1)))
+    for i in range(3)
+] + [(WINDOW_START + timedelta(days=30), None)]
+
+
+def sync_windows_out_of_order(monkeypatch, bookmarks, failing_window=None):
+    # every window waits for the one after it, so they finish last to first
+    finished = [threading.Event() for _ in WINDOWS]
+    monkeypatch.setattr(
+        output,
+        "write_state",
+        lambda state: bookmarks.append(state["bookmarks"]["accounts"]),
+    )
+
+    def sync_window(service, stream, mdata, window_start, window_end, config):
+        index = [start for start, _ in WINDOWS].index(window_start)
+        if index + 1 < len(WINDOWS):
+            assert finished[index + 1].wait(5)
+        finished[index].set()
+        if index == failing_window:
+            raise Exception("window {} failed".format(index))
+        return "2020-02-05T00:00:00.000000Z" if window_end is None else None
+
+    monkeypatch.setattr(sync_module, "sync_window", sync_window)
+
+    stream = get_stream()
+    sync_module.sync_stream_windows(
+        FakeService(),
+        {},
+        stream,
+        sync_module.metadata.to_map(stream.metadata),
+        WINDOWS,
+        "2019-12-31T23:59:59.000000Z",
+        {"max_parallel_windows": len(WINDOWS)},
+    )
+
+
+def get_next_since(bookmark):
+    # how sync_stream resumes from a bookmark
+    return sync_module.singer.utils.strptime_with_tz(bookmark) + timedelta(seconds=1)
+
+
+def test_window_bookmarks_follow_window_order(monkeypatch):
+    bookmarks = []
+    sync_windows_out_of_order(monkeypatch, bookmarks)
+
+    assert [get_next_since(bookmark) for bookmark in bookmarks[:3]] == [
+        window_end for _, window_end in WINDOWS[:3]
+    ]
+    assert bookmarks[3] == "2020-02-05T00:00:00.000000Z"
+
+
+def test_window_bookmarks_stop_before_a_failed_window(monkeypatch):
+    bookmarks = []
+    with pytest.raises(Exception, match="window 1 failed"):
+        sync_windows_out_of_order(monkeypatch, bookmarks, failing_window=1)
+
+    # windows 2 and 3 finished, but only window 0 may be skipped next run
+    assert len(bookmarks) == 1
+    assert get_next_since(bookmarks[0]) == WINDOWS[1][0]